@@ -224,7 +224,6 @@ class ConvertCocoPolysToMask(object):
                 segmentations = [[obj["segmentation"]] for obj in anno]
                 masks = convert_coco_poly_to_mask(segmentations, h, w, RandomCrop.region)
             else:
-                masks = torch.zeros_like(torchvision.transforms.ToTensor()(image)[0])
                 masks = torch.zeros((image.size[1],image.size[0]),dtype=torch.float32,device=boxes.device)
             target["masks"] = masks
 
@@ -291,4 +290,4 @@ def make_coco_transforms_cells(image_set):
     else:
         ValueError(f'unknown {image_set}')
 
-    return T.Compose(transforms), normalize
+    return T.FusedCompose(transforms), normalize
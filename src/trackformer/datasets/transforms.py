@@ -33,7 +33,7 @@ def crop(image, target, region, overflow_boxes=False):
     if "masks" in target:
 
         fields.append("masks")
-        area = target['masks'].sum(dim=(1,2))
+        area = target['masks'].flatten(1).count_nonzero(dim=1)
         target["area"] = area
 
         cropped_boxes = masks_to_boxes(target['masks'])
@@ -274,12 +274,22 @@ class RandomGaussianBlur:
         return img, target
 
 
-def gaussian_noise(img,target,sigma):
-    img = np.array(img)[:,:,0].astype(np.float32)
-    img = img + np.random.normal(0, sigma, img.shape).astype(np.float32)*255
-    img = np.clip(img,0,255).astype(np.uint8)
+def image_to_array(img):
+    return np.array(img)[:,:,0].astype(np.float32)
+
+def array_to_image(img):
+    # Clips in place; img is always a temporary produced by the array transforms
+    np.clip(img,0,255,out=img)
+    img = img.astype(np.uint8)
     img = np.repeat(img[:,:,None],3,axis=-1)
     img = PIL.Image.fromarray(img,'RGB')
+    return img
+
+def gaussian_noise_array(img,sigma):
+    return img + np.random.normal(0, sigma, img.shape).astype(np.float32)*255
+
+def gaussian_noise(img,target,sigma):
+    img = array_to_image(gaussian_noise_array(image_to_array(img),sigma))
     return img,target
 
 class RandomGaussianNoise:
@@ -287,6 +297,12 @@ class RandomGaussianNoise:
         self.p = p
         self.sigma = 0.05
 
+    def apply_array(self, img, target):
+        if random.random() < self.p:
+            sigma = random.random() * self.sigma
+            return gaussian_noise_array(img, sigma), target
+        return img, target
+
     def __call__(self, img, target):
         if random.random() < self.p:
             sigma = random.random() * self.sigma
@@ -295,8 +311,7 @@ class RandomGaussianNoise:
 
 
 
-def illumination_voodoo(img,target,num_control_points):
-    img = np.array(img)[:,:,0].astype(np.float32)
+def illumination_voodoo_array(img,num_control_points):
     # Create a random curve along the length of the chamber:
     control_points = np.linspace(0, img.shape[0] - 1, num=num_control_points)
     random_points = np.random.uniform(low=0.1, high=0.9, size=num_control_points)
@@ -314,10 +329,10 @@ def illumination_voodoo(img,target,num_control_points):
     newimage = np.interp(
         newimage, (newimage.min(), newimage.max()), (img.min(), img.max())
     )
+    return newimage
 
-    img = np.clip(newimage,0,255).astype(np.uint8)
-    img = np.repeat(img[:,:,None],3,axis=-1)
-    img = PIL.Image.fromarray(img,'RGB')
+def illumination_voodoo(img,target,num_control_points):
+    img = array_to_image(illumination_voodoo_array(image_to_array(img),num_control_points))
     return img,target
 
 class RandomIlluminationVoodoo:
@@ -325,6 +340,11 @@ class RandomIlluminationVoodoo:
         self.p = p
         self.num_control_points = 5
 
+    def apply_array(self, img, target):
+        if random.random() < self.p:
+            return illumination_voodoo_array(img, self.num_control_points), target
+        return img, target
+
     def __call__(self, img, target):
         if random.random() < self.p:
             return illumination_voodoo(img, target, self.num_control_points)
@@ -535,19 +555,18 @@ class Normalize:
         if target is None:
             return image, None
 
-        if not target['empty']:
+        if not target['empty'] and "boxes" in target:
             target = target.copy()
             h, w = image.shape[-2:]
-            if "boxes" in target:
-                boxes = target["boxes"]
-                boxes = torch.cat((box_xyxy_to_cxcywh(boxes[:,:4]),box_xyxy_to_cxcywh(boxes[:,4:])),axis=1)
-                boxes = boxes / torch.tensor([w, h, w, h, w, h, w, h], dtype=torch.float32)
-                target["boxes"] = boxes
+            boxes = target["boxes"]
+            boxes = torch.cat((box_xyxy_to_cxcywh(boxes[:,:4]),box_xyxy_to_cxcywh(boxes[:,4:])),axis=1)
+            boxes = boxes / torch.tensor([w, h, w, h, w, h, w, h], dtype=torch.float32)
+            target["boxes"] = boxes
 
-                if 'boxes_orig' in target:
-                    target['boxes_orig'] = boxes.clone()
+            if 'boxes_orig' in target:
+                target['boxes_orig'] = boxes.clone()
 
-                assert target['boxes'].shape[0] == (target['boxes'][:,2] > 0).sum() == (target['boxes'][:,3] > 0).sum()
+            assert target['boxes'].shape[0] == (target['boxes'][:,2] > 0).sum() == (target['boxes'][:,3] > 0).sum()
 
         return image, target
 
@@ -568,3 +587,47 @@ class Compose:
             format_string += "    {0}".format(t)
         format_string += "\n)"
         return format_string
+
+
+class FusedCompose(Compose):
+    """
+    Compose that runs consecutive numpy transforms (the ones defining apply_array)
+    on a single float32 array, so the image is converted from / to PIL once per
+    run of transforms instead of once per transform.
+    """
+    def __init__(self, transforms):
+        super().__init__(transforms)
+
+        # Group the transforms into stages of consecutive array / non-array transforms
+        self.stages = []
+        for t in transforms:
+            is_array = hasattr(t, 'apply_array')
+            if self.stages and self.stages[-1][0] == is_array:
+                self.stages[-1][1].append(t)
+            else:
+                self.stages.append((is_array, [t]))
+
+    def __call__(self, image, target=None):
+        for is_array, transforms in self.stages:
+            if not is_array:
+                for t in transforms:
+                    image, target = t(image, target)
+                continue
+
+            img = image_to_array(image)
+            applied = False
+            for t in transforms:
+                if applied:
+                    # Match the uint8 rounding each transform would have done on its own
+                    np.clip(img, 0, 255, out=img)
+                    np.floor(img, out=img)
+                    img = img.astype(np.float32, copy=False)
+                img_out, target = t.apply_array(img, target)
+                applied |= img_out is not img
+                img = img_out
+
+            # Transforms that were randomly skipped leave the image untouched
+            if applied:
+                image = array_to_image(img)
+
+        return image, target
@@ -70,8 +70,8 @@ def train_one_epoch(model: torch.nn.Module,
 
     for i, (samples, targets) in enumerate(data_loader):
 
-        samples = samples.to(args.device)
-        targets = [utils.nested_dict_to_device(t, args.device) for t in targets]
+        samples = samples.to(args.device, non_blocking=True)
+        targets = [utils.nested_dict_to_device(t, args.device, non_blocking=True) for t in targets]
 
         outputs, targets, _, _, _ = model(samples,targets)
 
@@ -124,7 +124,7 @@ def train_one_epoch(model: torch.nn.Module,
             OD_targets = [target['OD']['cur_target'] for target in targets]
             acc_dict = utils.calc_bbox_acc(acc_dict,outputs['OD'],OD_targets,args,text='OD_L1_')
 
-        metrics_dict = utils.update_metrics_dict(metrics_dict,acc_dict,loss_dict,weight_dict,i,lr)
+        metrics_dict = utils.update_metrics_dict(metrics_dict,acc_dict,loss_dict,weight_dict,i,len(data_loader),lr)
 
         if (i in ids and (epoch % 5 == 0 or epoch == 1)) and args.data_viz:
             data_viz.plot_results(outputs, targets,samples.tensors, args.output_dir, folder=dataset + '_outputs', filename = f'Epoch{epoch:03d}_Step{i:06d}.png', args=args)
@@ -145,8 +145,8 @@ def evaluate(model, criterion, data_loader, args, epoch: int = None, interval=50
     metrics_dict = {}
     for i, (samples, targets) in enumerate(data_loader):
          
-        samples = samples.to(args.device)
-        targets = [utils.nested_dict_to_device(t, args.device) for t in targets]
+        samples = samples.to(args.device, non_blocking=True)
+        targets = [utils.nested_dict_to_device(t, args.device, non_blocking=True) for t in targets]
 
         outputs, targets, _, _, _ = model(samples,targets)
         outputs, loss_dict = calc_loss_for_training_methods(outputs, targets, criterion)
@@ -178,7 +178,7 @@ def evaluate(model, criterion, data_loader, args, epoch: int = None, interval=50
             OD_targets = [target['OD']['cur_target'] for target in targets]
             acc_dict = utils.calc_bbox_acc(acc_dict,outputs['OD'],OD_targets,args,text='OD_L1_')
 
-        metrics_dict = utils.update_metrics_dict(metrics_dict,acc_dict,loss_dict,weight_dict,i)
+        metrics_dict = utils.update_metrics_dict(metrics_dict,acc_dict,loss_dict,weight_dict,i,len(data_loader))
 
         if i in ids and (epoch % 5 == 0 or epoch == 1) and args.data_viz:
             data_viz.plot_results(outputs, targets,samples.tensors, args.output_dir, folder=dataset + '_outputs', filename = f'Epoch{epoch:03d}_Step{i:06d}.png', args=args)
@@ -112,15 +112,15 @@ class DETRSegmBase(nn.Module):
         self.output_layers = nn.ModuleList(self.output_layers).to(self.device)
 
     def forward_prediction_heads(self, output, i):
+        # output is [B, Q, C] or, for several decoder layers at once, [L, B, Q, C]
         decoder_output = self.decoder_norm(output.transpose(0,1))
         decoder_output = decoder_output.transpose(0, 1)
 
         mask_embed = self.mask_embed[i](decoder_output)
 
-        outputs_mask_1 = torch.einsum("bqc,bchw->bqhw", mask_embed[:,:,:self.mask_dim], self.all_mask_features)
-        outputs_mask_2 = torch.einsum("bqc,bchw->bqhw", mask_embed[:,:,self.mask_dim:], self.all_mask_features)
-
-        outputs_mask = torch.stack((outputs_mask_1,outputs_mask_2),axis=2)
+        # Both masks of a query (second one for divisions) come from one einsum
+        mask_embed = mask_embed.unflatten(-1, (2, self.mask_dim))
+        outputs_mask = torch.einsum("...bqkc,bchw->...bqkhw", mask_embed, self.all_mask_features)
 
         return outputs_mask
 
@@ -133,13 +133,21 @@ class DETRSegmBase(nn.Module):
 
         out, targets, features, memory, hs = super().forward(samples, targets)
 
-        pred_masks = self.forward_prediction_heads(hs[-1],self.final_mask_embed_index)
-        out["pred_masks"] = pred_masks
+        if self.return_intermediate_masks and self.share_bbox_layers:
+            # All decoder layers share the mask head
+            all_pred_masks = self.forward_prediction_heads(hs,self.final_mask_embed_index)
+            out["pred_masks"] = all_pred_masks[-1]
 
-        if self.return_intermediate_masks:
             for i in range(len(hs) - 1):
-                pred_masks = self.forward_prediction_heads(hs[i],i)
-                out["aux_outputs"][i]['pred_masks'] = pred_masks
+                out["aux_outputs"][i]['pred_masks'] = all_pred_masks[i]
+        else:
+            pred_masks = self.forward_prediction_heads(hs[-1],self.final_mask_embed_index)
+            out["pred_masks"] = pred_masks
+
+            if self.return_intermediate_masks:
+                for i in range(len(hs) - 1):
+                    pred_masks = self.forward_prediction_heads(hs[i],i)
+                    out["aux_outputs"][i]['pred_masks'] = pred_masks
 
         if 'OD' in out:
             pred_masks = self.forward_prediction_heads(out['OD']['hs_embed'],self.OD_mask_embed_index)
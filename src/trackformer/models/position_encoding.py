@@ -9,13 +9,54 @@ from torch import nn
 from ..util.misc import NestedTensor
 
 
+def cached_embedding(cache, mask, embed, embed_unpadded, max_size=32):
+    """
+    Returns embed(mask), reusing the result per (h, w, device) when nothing is padded.
+    All samples then share the same embedding, built once by embed_unpadded(h, w, device).
+    """
+    if mask.any():
+        return embed(mask)
+
+    n, h, w = mask.shape
+    key = (h, w, mask.device)
+    if key not in cache:
+        if len(cache) >= max_size:
+            cache.clear()
+        cache[key] = embed_unpadded(h, w, mask.device)
+    pos = cache[key]
+    return pos.expand(n, *pos.shape[1:])
+
+
+def sine_cosine(embed, inv_dim_t, dtype=torch.float32):
+    """
+    Interleaved sin/cos features of embed[..., None] * inv_dim_t, computed in dtype.
+    inv_dim_t holds one frequency per sin/cos pair, i.e. half the output width.
+    """
+    args = embed.to(dtype).unsqueeze(-1) * inv_dim_t.to(dtype)
+    # Keep the sin/cos interleave rather than concatenating the halves: trained
+    # input projections depend on this channel order.
+    if not args.is_cuda:
+        # CPU sin/cos is only vectorized for contiguous outputs
+        return torch.stack([args.sin(), args.cos()], dim=-1).flatten(-2)
+    pos = args.new_empty(list(args.shape) + [2])
+    torch.sin(args, out=pos[..., 0])
+    torch.cos(args, out=pos[..., 1])
+    return pos.flatten(-2)
+
+
+def inverse_frequencies(num_pos_feats, temperature):
+    # dim_t = temperature ** (2 * (i // 2) / num_pos_feats) repeats in pairs, so only even i are kept
+    dim_t = torch.arange(0, num_pos_feats, 2, dtype=torch.float32)
+    return 1 / temperature ** (dim_t / num_pos_feats)
+
+
 class PositionEmbeddingSine3D(nn.Module):
     """
     This is a more standard version of the position embedding, very similar to the one
     used by the Attention is all you need paper, generalized to work on images.
     """
     # def __init__(self, num_pos_feats=64, temperature=10000, normalize=False, scale=None):
-    def __init__(self, num_pos_feats=64, num_frames=2, temperature=10000, normalize=False, scale=None):
+    def __init__(self, num_pos_feats=64, num_frames=2, temperature=10000, normalize=False, scale=None, use_bf16=False):
         super().__init__()
         self.num_pos_feats = num_pos_feats
         self.temperature = temperature
@@ -27,66 +68,75 @@ class PositionEmbeddingSine3D(nn.Module):
         if scale is None:
             scale = 2 * math.pi
         self.scale = scale
+        # bfloat16 sin/cos halves the traffic of the largest tensors but loses precision
+        self.dtype = torch.bfloat16 if use_bf16 else torch.float32
+        self._cache = {}
+        self.register_buffer('inv_dim_t', inverse_frequencies(num_pos_feats, temperature), persistent=False)
+
+        # All frames share the mask, so row k of the z embedding is frame k and row 0 padding
+        z_embed = torch.arange(num_frames + 1, dtype=torch.float32)
+        if normalize:
+            z_embed = z_embed / (num_frames + 1e-6) * scale
+        self.register_buffer('z_embedding', sine_cosine(z_embed, self.inv_dim_t, self.dtype), persistent=False)
 
     def forward(self, tensor_list: NestedTensor):
-        x = tensor_list.tensors
         mask = tensor_list.mask
-        n, h, w = mask.shape
-        # assert n == 1
-        # mask = mask.reshape(1, 1, h, w)
-        mask = mask.view(n, 1, h, w)
-        mask = mask.expand(n, self.frames, h, w)
-
         assert mask is not None
-        not_mask = ~mask
-        # y_embed = not_mask.cumsum(1, dtype=torch.float32)
-        # x_embed = not_mask.cumsum(2, dtype=torch.float32)
+        return cached_embedding(self._cache, mask, self.embed, self.embed_unpadded)
 
-        z_embed = not_mask.cumsum(1, dtype=torch.float32)
-        y_embed = not_mask.cumsum(2, dtype=torch.float32)
-        x_embed = not_mask.cumsum(3, dtype=torch.float32)
+    def embed(self, mask):
+        n, h, w = mask.shape
+        # All frames share the mask, so y/x are scanned on a single frame
+        not_mask = (~mask).view(n, 1, h, w)
+
+        y_embed = not_mask.cumsum(2, dtype=torch.int32)
+        x_embed = not_mask.cumsum(3, dtype=torch.int32)
 
         if self.normalize:
             eps = 1e-6
             # y_embed = y_embed / (y_embed[:, -1:, :] + eps) * self.scale
             # x_embed = x_embed / (x_embed[:, :, -1:] + eps) * self.scale
 
-            z_embed = z_embed / (z_embed[:, -1:, :, :] + eps) * self.scale
             y_embed = y_embed / (y_embed[:, :, -1:, :] + eps) * self.scale
             x_embed = x_embed / (x_embed[:, :, :, -1:] + eps) * self.scale
 
-        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=x.device)
-        dim_t = self.temperature ** (2 * (torch.div(dim_t,2,rounding_mode='floor')) / self.num_pos_feats)
-
-        # pos_x = x_embed[:, :, :, None] / dim_t
-        # pos_y = y_embed[:, :, :, None] / dim_t
-        # pos_x = torch.stack((
-        #     pos_x[:, :, :, 0::2].sin(),
-        #     pos_x[:, :, :, 1::2].cos()), dim=4).flatten(3)
-        # pos_y = torch.stack((
-        #     pos_y[:, :, :, 0::2].sin(),
-        #     pos_y[:, :, :, 1::2].cos()), dim=4).flatten(3)
-        # pos = torch.cat((pos_y, pos_x), dim=3).permute(0, 3, 1, 2)
-
-        pos_x = x_embed[:, :, :, :, None] / dim_t
-        pos_y = y_embed[:, :, :, :, None] / dim_t
-        pos_z = z_embed[:, :, :, :, None] / dim_t
-        pos_x = torch.stack((pos_x[:, :, :, :, 0::2].sin(), pos_x[:, :, :, :, 1::2].cos()), dim=5).flatten(4)
-        pos_y = torch.stack((pos_y[:, :, :, :, 0::2].sin(), pos_y[:, :, :, :, 1::2].cos()), dim=5).flatten(4)
-        pos_z = torch.stack((pos_z[:, :, :, :, 0::2].sin(), pos_z[:, :, :, :, 1::2].cos()), dim=5).flatten(4)
+        # Embedding y and x together as a trailing axis yields their concatenated channels
+        pos_yx = sine_cosine(torch.stack((y_embed, x_embed), dim=-1), self.inv_dim_t, self.dtype)
+        pos_yx = pos_yx.flatten(-2).expand(-1, self.frames, -1, -1, -1)
+        pos_z = torch.where(
+            mask.view(n, 1, h, w, 1), self.z_embedding[0], self.z_embedding[1:].view(1, self.frames, 1, 1, -1))
         # pos_w = torch.zeros_like(pos_z)
         # pos = torch.cat((pos_w, pos_z, pos_y, pos_x), dim=4).permute(0, 1, 4, 2, 3)
-        pos = torch.cat((pos_z, pos_y, pos_x), dim=4).permute(0, 1, 4, 2, 3)
+        # Channels stay last in memory, the layout the transformer's flatten(2).transpose(1, 2) wants
+        pos = torch.cat((pos_z, pos_yx), dim=4).permute(0, 1, 4, 2, 3)
 
         return pos
 
+    def embed_unpadded(self, h, w, device):
+        # Without padding each scan is an arange whose last value is known, so the
+        # normalisation folds into the frequencies and each axis is embedded once
+        y_embed = torch.arange(1, h + 1, dtype=torch.float32, device=device).view(1, 1, -1, 1)
+        x_embed = torch.arange(1, w + 1, dtype=torch.float32, device=device).view(1, 1, 1, -1)
+        inv_y = inv_x = self.inv_dim_t
+
+        if self.normalize:
+            eps = 1e-6
+            inv_y = self.inv_dim_t * (self.scale / (h + eps))
+            inv_x = self.inv_dim_t * (self.scale / (w + eps))
+
+        size = (1, self.frames, h, w, -1)
+        pos_z = self.z_embedding[1:].view(1, self.frames, 1, 1, -1).expand(size)
+        pos_y = sine_cosine(y_embed, inv_y, self.dtype).expand(size)
+        pos_x = sine_cosine(x_embed, inv_x, self.dtype).expand(size)
+        return torch.cat((pos_z, pos_y, pos_x), dim=4).permute(0, 1, 4, 2, 3)
+
 
 class PositionEmbeddingSine(nn.Module):
     """
     This is a more standard version of the position embedding, very similar to the one
     used by the Attention is all you need paper, generalized to work on images.
     """
-    def __init__(self, num_pos_feats=64, temperature=10000, normalize=False, scale=None):
+    def __init__(self, num_pos_feats=64, temperature=10000, normalize=False, scale=None, use_bf16=False):
         super().__init__()
         self.num_pos_feats = num_pos_feats
         self.temperature = temperature
@@ -96,17 +146,21 @@ class PositionEmbeddingSine(nn.Module):
         if scale is None:
             scale = 2 * math.pi
         self.scale = scale
+        self.dtype = torch.bfloat16 if use_bf16 else torch.float32
+        self._cache = {}
+        self.register_buffer('inv_dim_t', inverse_frequencies(num_pos_feats, temperature), persistent=False)
 
     def deterministic_cumsum(self, t, dim):
-        output = torch.zeros_like(t).float()
-        for i in range(1, t.size(dim)):
-            output.select(dim, i).add_(output.select(dim, i-1)).add_(t.select(dim, i))
-        return output
+        # The first element is left out of the sum
+        t = t.int()
+        return t.cumsum(dim, dtype=torch.int32) - t.narrow(dim, 0, 1)
 
     def forward(self, tensor_list: NestedTensor):
-        x = tensor_list.tensors
         mask = tensor_list.mask
         assert mask is not None
+        return cached_embedding(self._cache, mask, self.embed, self.embed_unpadded)
+
+    def embed(self, mask):
         not_mask = ~mask
         # y_embed = not_mask.cumsum(1, dtype=torch.float32)
         # x_embed = not_mask.cumsum(2, dtype=torch.float32)
@@ -119,16 +173,26 @@ class PositionEmbeddingSine(nn.Module):
             y_embed = (y_embed - 0.5) / (y_embed[:, -1:, :] + eps) * self.scale
             x_embed = (x_embed - 0.5) / (x_embed[:, :, -1:] + eps) * self.scale
 
-        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=x.device)
-        dim_t = self.temperature ** (2 * (torch.div(dim_t,2,rounding_mode='floor')) / self.num_pos_feats)
-
-        pos_x = x_embed[:, :, :, None] / dim_t
-        pos_y = y_embed[:, :, :, None] / dim_t
-        pos_x = torch.stack((pos_x[:, :, :, 0::2].sin(), pos_x[:, :, :, 1::2].cos()), dim=4).flatten(3)
-        pos_y = torch.stack((pos_y[:, :, :, 0::2].sin(), pos_y[:, :, :, 1::2].cos()), dim=4).flatten(3)
-        pos = torch.cat((pos_y, pos_x), dim=3).permute(0, 3, 1, 2)
+        pos = sine_cosine(torch.stack((y_embed, x_embed), dim=-1), self.inv_dim_t, self.dtype)
+        pos = pos.flatten(-2).permute(0, 3, 1, 2)
         return pos
 
+    def embed_unpadded(self, h, w, device):
+        y_embed = torch.arange(h, dtype=torch.float32, device=device).view(1, -1, 1)
+        x_embed = torch.arange(w, dtype=torch.float32, device=device).view(1, 1, -1)
+        inv_y = inv_x = self.inv_dim_t
+
+        if self.normalize:
+            eps = 1e-6
+            y_embed = y_embed - 0.5
+            x_embed = x_embed - 0.5
+            inv_y = self.inv_dim_t * (self.scale / (h - 1 + eps))
+            inv_x = self.inv_dim_t * (self.scale / (w - 1 + eps))
+
+        pos_y = sine_cosine(y_embed, inv_y, self.dtype).expand(1, h, w, -1)
+        pos_x = sine_cosine(x_embed, inv_x, self.dtype).expand(1, h, w, -1)
+        return torch.cat((pos_y, pos_x), dim=3).permute(0, 3, 1, 2)
+
 
 class PositionEmbeddingLearned(nn.Module):
     """
@@ -139,6 +203,8 @@ class PositionEmbeddingLearned(nn.Module):
         self.row_embed = nn.Embedding(50, num_pos_feats)
         self.col_embed = nn.Embedding(50, num_pos_feats)
         self.reset_parameters()
+        self._cache = {}
+        self._weight_version = None
 
     def reset_parameters(self):
         nn.init.uniform_(self.row_embed.weight)
@@ -147,14 +213,31 @@ class PositionEmbeddingLearned(nn.Module):
     def forward(self, tensor_list: NestedTensor):
         x = tensor_list.tensors
         h, w = x.shape[-2:]
-        i = torch.arange(w, device=x.device)
-        j = torch.arange(h, device=x.device)
+
+        # Cached without gradients; the weights' _version catches in-place updates
+        if self.training or torch.is_grad_enabled():
+            pos = self.embed(h, w, x.device)
+        else:
+            version = (self.row_embed.weight._version, self.col_embed.weight._version)
+            if version != self._weight_version:
+                self._cache.clear()
+                self._weight_version = version
+            key = (h, w, x.device)
+            if key not in self._cache:
+                self._cache[key] = self.embed(h, w, x.device)
+            pos = self._cache[key]
+
+        return pos.expand(x.shape[0], -1, -1, -1)
+
+    def embed(self, h, w, device):
+        i = torch.arange(w, device=device)
+        j = torch.arange(h, device=device)
         x_emb = self.col_embed(i)
         y_emb = self.row_embed(j)
         pos = torch.cat([
-            x_emb.unsqueeze(0).repeat(h, 1, 1),
-            y_emb.unsqueeze(1).repeat(1, w, 1),
-        ], dim=-1).permute(2, 0, 1).unsqueeze(0).repeat(x.shape[0], 1, 1, 1)
+            x_emb.unsqueeze(0).expand(h, -1, -1),
+            y_emb.unsqueeze(1).expand(-1, w, -1),
+        ], dim=-1).permute(2, 0, 1).unsqueeze(0)
         return pos
 
 
@@ -171,7 +254,8 @@ def build_position_encoding(args):
 
     if args.position_embedding in ('v2', 'sine'):
         # TODO find a better way of exposing other arguments
-        position_embedding = sine_emedding_func(n_steps, normalize=True)
+        position_embedding = sine_emedding_func(
+            n_steps, normalize=True, use_bf16=getattr(args, 'position_embedding_bf16', False))
     elif args.position_embedding in ('v3', 'learned'):
         position_embedding = PositionEmbeddingLearned(n_steps)
     else:
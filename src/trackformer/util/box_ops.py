@@ -50,6 +50,24 @@ def box_iou(boxes1, boxes2):
     return iou, union
 
 
+def paired_box_iou(boxes1, boxes2):
+    """
+    IoU of boxes1[i] with boxes2[i] for matched [N, 4] boxes in [x0, y0, x1, y1] format.
+
+    Returns an [N] tensor instead of the [N, M] pairwise matrix of box_iou.
+    """
+    area1 = box_area(boxes1)
+    area2 = box_area(boxes2)
+
+    lt = torch.max(boxes1[:, :2], boxes2[:, :2])  # [N,2]
+    rb = torch.min(boxes1[:, 2:], boxes2[:, 2:])  # [N,2]
+
+    wh = (rb - lt).clamp(min=0)  # [N,2]
+    inter = wh[:, 0] * wh[:, 1]  # [N]
+
+    return inter / (area1 + area2 - inter)
+
+
 def generalized_box_iou(boxes1, boxes2, return_iou_only = False):
     """
     Generalized IoU from https://giou.stanford.edu/
@@ -96,25 +114,24 @@ def masks_to_boxes(masks,cxcywh=False):
 
     h, w = masks.shape[-2:]
 
-    y = torch.arange(0, h, dtype=torch.float, device=masks.device)
-    x = torch.arange(0, w, dtype=torch.float, device=masks.device)
-    y, x = torch.meshgrid(y, x)
-
-    x_mask = (masks * x.unsqueeze(0))
-    x_max = x_mask.flatten(1).max(-1)[0]
-    x_min = x_mask.masked_fill(~(masks.bool()), 1e8).flatten(1).min(-1)[0]
+    if masks.dtype != torch.bool:
+        masks = masks != 0
 
-    y_mask = (masks * y.unsqueeze(0))
-    y_max = y_mask.flatten(1).max(-1)[0]
-    y_min = y_mask.masked_fill(~(masks.bool()), 1e8).flatten(1).min(-1)[0]
+    # Box edges are the first / last occupied row and column
+    rows = masks.any(2)
+    cols = masks.any(1)
 
+    y_min = rows.int().argmax(1).float()
+    y_max = (h - 1 - rows.flip(1).int().argmax(1)).float()
+    x_min = cols.int().argmax(1).float()
+    x_max = (w - 1 - cols.flip(1).int().argmax(1)).float()
 
     if cxcywh:
         boxes = torch.stack([(x_min+x_max)/2/w, (y_min+y_max)/2/h, (x_max-x_min)/w, (y_max-y_min)/h], 1)
     else:
         boxes = torch.stack([x_min, y_min, x_max, y_max], 1)
 
-    boxes[masks.sum((1,2)) == 0] = torch.tensor([0,0,0,0],dtype=boxes.dtype,device=masks.device)
+    boxes[~rows.any(1)] = 0
 
     if cxcywh:
         assert (boxes[::2] > 1).sum() == 0 and (boxes[1::2] > 1).sum() == 0
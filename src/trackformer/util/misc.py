@@ -5,6 +5,7 @@ Misc functions, including distributed helpers.
 Mostly copy-paste from torchvision references.
 """
 import datetime
+import functools
 import os
 import pickle
 import subprocess
@@ -29,6 +30,7 @@ if int(re.findall('\d+',(torchvision.__version__[:4]))[-1]) < 7:
     from torchvision.ops import _new_empty_tensor
     from torchvision.ops.misc import _output_size
 
+@functools.lru_cache(maxsize=1)
 def get_sha():
     cwd = os.path.dirname(os.path.abspath(__file__))
 
@@ -38,11 +40,9 @@ def get_sha():
     diff = "clean"
     branch = 'N/A'
     try:
-        sha = _run(['git', 'rev-parse', 'HEAD'])
-        subprocess.check_output(['git', 'diff'], cwd=cwd)
-        diff = _run(['git', 'diff-index', 'HEAD'])
+        sha, branch = _run(['git', 'rev-parse', 'HEAD', '--abbrev-ref', 'HEAD']).split('\n')
+        diff = _run(['git', 'status', '--porcelain', '--untracked-files=no'])
         diff = "has uncommited changes" if diff else "clean"
-        branch = _run(['git', 'rev-parse', '--abbrev-ref', 'HEAD'])
     except Exception:
         pass
     message = f"sha: {sha}, status: {diff}, branch: {branch}"
@@ -57,62 +57,64 @@ def collate_fn(batch):
 
 def _max_by_axis(the_list):
     # type: (List[List[int]]) -> List[int]
-    maxes = the_list[0]
-    for sublist in the_list[1:]:
-        for index, item in enumerate(sublist):
-            maxes[index] = max(maxes[index], item)
-    return maxes
+    return [max(sizes) for sizes in zip(*the_list)]
 
 
 def nested_tensor_from_tensor_list(tensor_list: List[Tensor]):
     # TODO make this more general
-    if tensor_list[0].ndim == 3:
-        # TODO make it support different-sized images
-        max_size = _max_by_axis([list(img.shape) for img in tensor_list])
-        # min_size = tuple(min(s) for s in zip(*[img.shape for img in tensor_list]))
-        batch_shape = [len(tensor_list)] + max_size
-        b, _, h, w = batch_shape
-        dtype = tensor_list[0].dtype
-        device = tensor_list[0].device
-        tensor = torch.zeros(batch_shape, dtype=dtype, device=device)
-        mask = torch.ones((b, h, w), dtype=torch.bool, device=device)
-        for img, pad_img, m in zip(tensor_list, tensor, mask):
-            pad_img[: img.shape[0], : img.shape[1], : img.shape[2]].copy_(img)
-            m[: img.shape[1], :img.shape[2]] = False
-
-    elif tensor_list[0].ndim == 4:
-        # TODO make it support different-sized images
-        max_size = _max_by_axis([list(img.shape) for img in tensor_list])
-        # min_size = tuple(min(s) for s in zip(*[img.shape for img in tensor_list]))
-        batch_shape = [len(tensor_list)] + max_size 
-        b, _, n, h, w = batch_shape
-        dtype = tensor_list[0].dtype
-        device = tensor_list[0].device
-        tensor = torch.zeros(batch_shape, dtype=dtype, device=device)
-        mask = torch.ones((b, n, h, w), dtype=torch.bool, device=device)
-        for img, pad_img, m in zip(tensor_list, tensor, mask):
-            pad_img[: img.shape[0], : img.shape[1], : img.shape[2], : img.shape[3]].copy_(img)
-            m[:, : img.shape[2], :img.shape[3]] = False
-    else:
+    if tensor_list[0].ndim not in (3, 4):
         raise ValueError('not supported')
-    return NestedTensor(tensor, mask)
+
+    max_size = _max_by_axis([img.shape for img in tensor_list])
+    batch_shape = [len(tensor_list)] + max_size
+    h, w = batch_shape[-2:]
+    device = tensor_list[0].device
+
+    sizes = torch.tensor([img.shape[-2:] for img in tensor_list])
+
+    if all(img.shape == tensor_list[0].shape for img in tensor_list):
+        # Same-sized images have no padding to mask
+        tensor = torch.stack(tensor_list)
+        mask = torch.zeros(tensor.shape[:1] + tensor.shape[2:], dtype=torch.bool, device=device)
+        return NestedTensor(tensor, mask, sizes)
+
+    tensor = torch.zeros(batch_shape, dtype=tensor_list[0].dtype, device=device)
+    for img, pad_img in zip(tensor_list, tensor):
+        pad_img[tuple(slice(0, size) for size in img.shape)].copy_(img)
+
+    mask = (torch.arange(h).view(1, h, 1) >= sizes[:, 0, None, None]) \
+         | (torch.arange(w).view(1, 1, w) >= sizes[:, 1, None, None])
+    mask = mask.to(device)
+    if tensor.ndim == 5:
+        # Frames share the mask of their image
+        mask = mask.unsqueeze(1).repeat(1, batch_shape[2], 1, 1)
+    return NestedTensor(tensor, mask, sizes)
 
 
 class NestedTensor(object):
-    def __init__(self, tensors, mask: Optional[Tensor] = None):
+    def __init__(self, tensors, mask: Optional[Tensor] = None, sizes: Optional[Tensor] = None):
         self.tensors = tensors
         self.mask = mask
+        # (h, w) of each unpadded image, kept on the CPU
+        self.sizes = sizes
 
-    def to(self, device):
-        # type: (Device) -> NestedTensor # noqa
-        cast_tensor = self.tensors.to(device)
+    def to(self, device, non_blocking=False):
+        # type: (Device, bool) -> NestedTensor # noqa
+        cast_tensor = self.tensors.to(device, non_blocking=non_blocking)
         mask = self.mask
         if mask is not None:
             assert mask is not None
-            cast_mask = mask.to(device)
+            cast_mask = mask.to(device, non_blocking=non_blocking)
         else:
             cast_mask = None
-        return NestedTensor(cast_tensor, cast_mask)
+        return NestedTensor(cast_tensor, cast_mask, self.sizes)
+
+    def pin_memory(self):
+        # Called by the DataLoader when pin_memory=True
+        self.tensors = self.tensors.pin_memory()
+        if self.mask is not None:
+            self.mask = self.mask.pin_memory()
+        return self
 
     def decompose(self):
         return self.tensors, self.mask
@@ -123,18 +125,14 @@ class NestedTensor(object):
     def unmasked_tensor(self, index: int):
         tensor = self.tensors[index]
 
-        if not self.mask[index].any():
-            return tensor
-
-        h_index = self.mask[index, 0, :].nonzero(as_tuple=True)[0]
-        if len(h_index):
-            tensor = tensor[:, :, :h_index[0]]
-
-        w_index = self.mask[index, :, 0].nonzero(as_tuple=True)[0]
-        if len(w_index):
-            tensor = tensor[:, :w_index[0], :]
+        if self.sizes is not None:
+            h, w = self.sizes[index].tolist()
+        else:
+            # Padding is a bottom/right border; frames share the mask
+            not_mask = ~self.mask[index].view(-1, *self.mask.shape[-2:])[0]
+            h, w = torch.stack((not_mask[:, 0].sum(), not_mask[0].sum())).tolist()
 
-        return tensor
+        return tensor[..., :h, :w]
 
 
 def setup_for_distributed(is_master):
@@ -161,16 +159,17 @@ def is_dist_avail_and_initialized():
     return True
 
 
+# Set by init_distributed_mode
+_WORLD_SIZE = 1
+_RANK = 0
+
+
 def get_world_size():
-    if not is_dist_avail_and_initialized():
-        return 1
-    return dist.get_world_size()
+    return _WORLD_SIZE
 
 
 def get_rank():
-    if not is_dist_avail_and_initialized():
-        return 0
-    return dist.get_rank()
+    return _RANK
 
 
 def is_main_process():
@@ -205,6 +204,8 @@ def init_distributed_mode(args):
         backend=args.dist_backend, init_method=args.dist_url,
         world_size=args.world_size, rank=args.rank)
     # torch.distributed.barrier()
+    global _WORLD_SIZE, _RANK
+    _WORLD_SIZE, _RANK = dist.get_world_size(), dist.get_rank()
     setup_for_distributed(args.rank == 0)
 
 
@@ -236,19 +237,22 @@ class DistributedWeightedSampler(torch.utils.data.DistributedSampler):
 
         self.replacement = replacement
 
+        if hasattr(self.dataset, 'sample_weight'):
+            self.weights = torch.tensor([self.dataset.sample_weight(idx) for idx in range(len(self.dataset))])
+
     def __iter__(self):
         iter_indices = super(DistributedWeightedSampler, self).__iter__()
         if hasattr(self.dataset, 'sample_weight'):
-            indices = list(iter_indices)
+            indices = torch.as_tensor(list(iter_indices), dtype=torch.long)
 
-            weights = torch.tensor([self.dataset.sample_weight(idx) for idx in indices])
+            weights = self.weights.index_select(0, indices)
 
             g = torch.Generator()
             g.manual_seed(self.epoch)
 
             weight_indices = torch.multinomial(
                 weights, self.num_samples, self.replacement, generator=g)
-            indices = torch.tensor(indices)[weight_indices]
+            indices = indices.index_select(0, weight_indices)
 
             iter_indices = iter(indices.tolist())
         return iter_indices
@@ -297,12 +301,12 @@ def sigmoid_focal_loss(inputs, targets, num_boxes, weights, alpha: float = 0.25,
         Loss tensor
     """
             
-    prob = inputs.sigmoid()
     ce_loss = F.binary_cross_entropy_with_logits(inputs, targets, reduction="none",weight=weights)
 
     if mask:
         return ce_loss.mean(1).sum() / num_boxes
 
+    prob = inputs.sigmoid()
     p_t = prob * targets + (1 - prob) * (1 - targets)
     loss = ce_loss * ((1 - p_t) ** gamma)
 
@@ -314,7 +318,9 @@ def sigmoid_focal_loss(inputs, targets, num_boxes, weights, alpha: float = 0.25,
         return loss
 
     if query_mask is not None:
-        loss = torch.stack([l[m].mean(0) for l, m in zip(loss, query_mask)])
+        # torch.where so a non-finite loss at a masked-out query can't turn the row into nan
+        query_mask = query_mask.bool().view(query_mask.shape + (1,) * (loss.dim() - 2))
+        loss = torch.where(query_mask, loss, loss.new_zeros(())).sum(1) / query_mask.sum(1).clamp_min(1)
         return loss.sum() / num_boxes
     return loss.mean(1).sum() / num_boxes
 
@@ -327,16 +333,23 @@ def nested_dict_to_namespace(dictionary):
             setattr(namespace, key, nested_dict_to_namespace(value))
     return namespace
 
-def nested_dict_to_device(dictionary, device):
+def nested_dict_to_device(dictionary, device, non_blocking=False):
+    if not isinstance(dictionary, dict):
+        return dictionary.to(device, non_blocking=non_blocking)
+
     output = {}
-    if isinstance(dictionary, dict):
-        for key, value in dictionary.items():
-            if not isinstance(value, str):
-                output[key] = nested_dict_to_device(value, device)
+    stack = [(dictionary, output)]
+    while stack:
+        src, dst = stack.pop()
+        for key, value in src.items():
+            if isinstance(value, dict):
+                dst[key] = {}
+                stack.append((value, dst[key]))
+            elif isinstance(value, str):
+                dst[key] = value
             else:
-                output[key] = value
-        return output
-    return dictionary.to(device)
+                dst[key] = value.to(device, non_blocking=non_blocking)
+    return output
 
 def threshold_indices(indices,targets,training_method,target_name,max_ind):
     '''
@@ -350,23 +363,27 @@ def threshold_indices(indices,targets,training_method,target_name,max_ind):
 
     for (ind_out,ind_tgt),target in zip(indices,targets):
 
-        for i in range(len(ind_out)):
-          
-            if ind_out[i] >= max_ind:
-                ind_out[i] -= max_ind
+        swap = ind_out >= max_ind
+        if not swap.any():
+            continue
+
+        ind_out[swap] -= max_ind
+        swap_ind = ind_tgt[swap]
+        tgt = target[training_method][target_name]
 
-                assert target[training_method][target_name]['boxes'][ind_tgt[i]][-1] > 0, 'Currently, this only swaps boxes where divisions have occurred. Object detection should only occur in the first box, not the second.'
+        assert (tgt['boxes'][swap_ind,-1] > 0).all(), 'Currently, this only swaps boxes where divisions have occurred. Object detection should only occur in the first box, not the second.'
 
-                target[training_method][target_name]['boxes'][ind_tgt[i]] = torch.cat((target[training_method][target_name]['boxes'][ind_tgt[i],4:],target[training_method][target_name]['boxes'][ind_tgt[i],:4]),axis=-1)
-                target[training_method][target_name]['labels'][ind_tgt[i]] = torch.cat((target[training_method][target_name]['labels'][ind_tgt[i],1:],target[training_method][target_name]['labels'][ind_tgt[i],:1]),axis=-1)
+        # Swap the two halves of every matched target at once
+        tgt['boxes'][swap_ind] = tgt['boxes'][swap_ind].roll(-4,dims=-1)
+        tgt['labels'][swap_ind] = tgt['labels'][swap_ind].roll(-1,dims=-1)
 
-                if 'masks' in target[training_method][target_name]:
-                    target[training_method][target_name]['masks'][ind_tgt[i]] = torch.cat((target[training_method][target_name]['masks'][ind_tgt[i],1:],target[training_method][target_name]['masks'][ind_tgt[i],:1]),axis=0)
+        if 'masks' in tgt:
+            tgt['masks'][swap_ind] = tgt['masks'][swap_ind].roll(-1,dims=1)
 
     return indices, targets
 
 
-def update_metrics_dict(metrics_dict:dict,acc_dict:dict,loss_dict:dict,weight_dict:dict,i,lr=None):
+def update_metrics_dict(metrics_dict:dict,acc_dict:dict,loss_dict:dict,weight_dict:dict,i,i_total,lr=None):
     '''
     After every iteration, the metrics dict is updated with the current loss and acc for that sample
 
@@ -380,38 +397,42 @@ def update_metrics_dict(metrics_dict:dict,acc_dict:dict,loss_dict:dict,weight_di
     Stores weights for each loss
     i: int
     Iteration number
+    i_total: int
+    Number of iterations in the epoch
     '''
     
     metrics_keys = ['det_bbox_acc','det_mask_acc','track_bbox_acc','track_mask_acc','divisions_bbox_acc','divisions_mask_acc','new_cells_bbox_acc','new_cells_mask_acc','new_cells_not_edge_bbox_acc','new_cells_not_edge_mask_acc']
 
+    loss_keys = [key for key in weight_dict.keys() if key in loss_dict]
+    losses = dict(zip(loss_keys, torch.stack([loss_dict[key].detach().float() for key in loss_keys]).cpu().numpy())) if loss_keys else {}
+
+    # Steps without a value stay nan
     if i == 0:
         for metrics_key in metrics_keys:
-            if metrics_key in acc_dict.keys(): # add the accuracy info; these are two digits; first is # correct; second is total #
-                metrics_dict[metrics_key] = acc_dict[metrics_key]
-            else:
-                metrics_dict[metrics_key] = np.ones((1,1,2)) * np.nan
+            metrics_dict[metrics_key] = np.ones((1,i_total,2)) * np.nan
 
-        for weight_dict_key in weight_dict.keys(): # add the loss info which is a single number
-            metrics_dict[weight_dict_key] = (loss_dict[weight_dict_key].detach().cpu().numpy()[None,None] * weight_dict[weight_dict_key]) if weight_dict_key in loss_dict else np.array(np.nan)[None,None]
+        for weight_dict_key in weight_dict.keys():
+            metrics_dict[weight_dict_key] = np.ones((1,i_total)) * np.nan
         
         if lr is not None:
             metrics_dict['lr'] = lr
-        
-    else:
-        for metrics_key in metrics_keys:
-            if metrics_key in acc_dict.keys():
-                metrics_dict[metrics_key] = np.concatenate((metrics_dict[metrics_key],acc_dict[metrics_key]),axis=1)
-            else:
-                metrics_dict[metrics_key] = np.concatenate((metrics_dict[metrics_key],np.ones((1,1,2)) * np.nan),axis=1)
 
-        for weight_dict_key in weight_dict.keys():
-            loss_dict_key_loss = (loss_dict[weight_dict_key].detach().cpu().numpy()[None,None] * weight_dict[weight_dict_key]) if weight_dict_key in loss_dict else np.array(np.nan)[None,None]
-            metrics_dict[weight_dict_key] = np.concatenate((metrics_dict[weight_dict_key],loss_dict_key_loss),axis=1)
+    for metrics_key in metrics_keys:
+        if metrics_key in acc_dict.keys(): # add the accuracy info; these are two digits; first is # correct; second is total #
+            metrics_dict[metrics_key][:,i] = acc_dict[metrics_key][:,0]
+
+    for loss_key, loss in losses.items(): # add the loss info which is a single number
+        metrics_dict[loss_key][:,i] = loss * weight_dict[loss_key]
 
     assert metrics_dict['loss'].shape[0] == 1, 'Only one epoch worth of loss / metric info should be added'
 
     return metrics_dict
 
+@functools.lru_cache(maxsize=8)
+def display_loss_keys(keys):
+    '''Keys printed by display_loss; cached since the metric keys are the same every step'''
+    return [key for key in keys if ('loss' in key and not any(c.isdigit() for c in key) and key != 'lr') or 'CoMOT' in key]
+
 def display_loss(metrics_dict:dict,i,i_total,epoch,dataset):
     '''Print the loss
     
@@ -422,9 +443,8 @@ def display_loss(metrics_dict:dict,i,i_total,epoch,dataset):
 
     display_loss = {}
 
-    for key in metrics_dict.keys():
-        if ('loss' in key and not bool(re.search('\d',key)) and key != 'lr') or 'CoMOT' in key:
-            display_loss[key] = f'{np.nan if np.isnan(metrics_dict[key][-1]).all() else np.nanmean(metrics_dict[key][-1]):.4f}'
+    for key in display_loss_keys(tuple(metrics_dict.keys())):
+        display_loss[key] = f'{np.nan if np.isnan(metrics_dict[key][-1]).all() else np.nanmean(metrics_dict[key][-1]):.4f}'
 
     pad = int(math.log10(i_total))+1
     print(f'{dataset}  Epoch: {epoch} ({i:0{pad}}/{i_total-1})',display_loss)
@@ -447,19 +467,38 @@ def save_metrics_pkl(metrics_dict,output_dir,dataset,epoch):
 
 
 
+def matched_box_iou(pred_boxes, tgt_boxes):
+    """ IoU of each [N, 4] cxcywh predicted box with its matched target box """
+    return box_ops.paired_box_iou(box_ops.box_cxcywh_to_xyxy(pred_boxes), box_ops.box_cxcywh_to_xyxy(tgt_boxes))
+
+def matched_mask_iou(pred_masks, tgt_masks):
+    """ IoU of each [N, 1, h, w] predicted mask, upsampled to the target size and thresholded, with its matched target mask """
+    if len(pred_masks) == 0:
+        return pred_masks.new_zeros(0)
+    pred_masks_scaled = F.interpolate(pred_masks, size=tgt_masks.shape[-2:], mode="bilinear", align_corners=False)
+    pred_masks_scaled = (pred_masks_scaled > 0.5) * 1.
+    return box_ops.mask_iou(pred_masks_scaled.flatten(1), tgt_masks.flatten(1))
+
+def count_correct(scored, correct):
+    """ Number of correct and of all scored matches, kept as device tensors """
+    return (scored & correct).sum(), scored.sum()
+
 def calc_bbox_acc(acc_dict,outputs,targets,args,calc_mask_acc=True,text=''):
     cls_thresh = args.cls_threshold
     iou_thresh = args.iou_threshold
-    TP_bbox = TP_mask = FN = FP = FP_bbox = FP_mask = 0
+    TP_bbox, TP_mask, FN, FP, FP_bbox, FP_mask = [torch.zeros((), dtype=torch.int64, device=outputs['pred_logits'].device) for _ in range(6)]
     for t,target in enumerate(targets):
         indices = target['indices']
         pred_logits = outputs['pred_logits'].sigmoid().detach()[t]
 
         if target['empty']: # No objects in image so it should be all zero
-            FP += int((pred_logits > cls_thresh).sum())
+            FP += (pred_logits > cls_thresh).sum()
             continue
 
-        FP += sum([1 for ind in range(pred_logits.shape[0]) if (ind not in indices[0] and pred_logits[ind,0] > cls_thresh)])
+        ind_out, ind_tgt = indices[0].to(pred_logits.device), indices[1].to(pred_logits.device)
+        unmatched = torch.ones(pred_logits.shape[0], dtype=torch.bool, device=pred_logits.device)
+        unmatched[ind_out] = False
+        FP += ((pred_logits[:,0] > cls_thresh) & unmatched).sum()
 
         pred_boxes = outputs['pred_boxes'].detach()[t]
         tgt_boxes = target['boxes'].detach()
@@ -472,30 +511,22 @@ def calc_bbox_acc(acc_dict,outputs,targets,args,calc_mask_acc=True,text=''):
             pred_masks = outputs['pred_masks'].sigmoid().detach()[t]
             tgt_masks = target['masks'].detach()
 
-        for ind_out, ind_tgt in zip(indices[0],indices[1]):
-            if pred_logits[ind_out,0] > cls_thresh:
-                iou = box_ops.generalized_box_iou(
-                    box_ops.box_cxcywh_to_xyxy(pred_boxes[ind_out:ind_out+1,:4]),
-                    box_ops.box_cxcywh_to_xyxy(tgt_boxes[ind_tgt:ind_tgt+1,:4]),
-                    return_iou_only=True)
+        # Matched queries below the class threshold are FNs
+        detected = pred_logits[ind_out,0] > cls_thresh
+        FN += (~detected).sum()
 
-                if iou > iou_thresh:
-                    TP_bbox += 1
-                else:
-                    FP_bbox += 1
+        correct = matched_box_iou(pred_boxes[ind_out,:4], tgt_boxes[ind_tgt,:4]) > iou_thresh
+        num_correct, num_scored = count_correct(detected, correct)
+        TP_bbox += num_correct
+        FP_bbox += num_scored - num_correct
 
-                if 'pred_masks' in outputs and calc_mask_acc:
-                    pred_mask = pred_masks[ind_out:ind_out+1,:1]
-                    pred_mask_scaled = F.interpolate(pred_mask, size=tgt_masks.shape[-2:], mode="bilinear", align_corners=False)
-                    pred_mask_scaled = (pred_mask_scaled > 0.5) * 1.
-                    mask_iou = box_ops.mask_iou(pred_mask_scaled.flatten(1),tgt_masks[ind_tgt:ind_tgt+1,:1].flatten(1))
+        if 'pred_masks' in outputs and calc_mask_acc:
+            correct = matched_mask_iou(pred_masks[ind_out,:1], tgt_masks[ind_tgt,:1]) > iou_thresh
+            num_correct, num_scored = count_correct(detected, correct)
+            TP_mask += num_correct
+            FP_mask += num_scored - num_correct
 
-                    if mask_iou > iou_thresh:
-                        TP_mask += 1
-                    else:
-                        FP_mask += 1
-            else:
-                FN += 1
+    TP_bbox, TP_mask, FN, FP, FP_bbox, FP_mask = torch.stack((TP_bbox, TP_mask, FN, FP, FP_bbox, FP_mask)).tolist()
 
     acc_dict[text+'det_bbox_acc'] = np.array((TP_bbox,TP_bbox + FN + FP + FP_bbox),dtype=np.int32)[None,None]
 
@@ -507,13 +538,9 @@ def calc_bbox_acc(acc_dict,outputs,targets,args,calc_mask_acc=True,text=''):
 def calc_track_acc(track_acc_dict,outputs,targets,args, calc_mask_acc=True):
     cls_thresh = args.cls_threshold
     iou_thresh = args.iou_threshold
-    TP_bbox = TP_mask = FN = FP = FP_bbox = FP_mask = 0
-    div_acc = np.zeros((2),dtype=np.int32)
-    div_bbox_acc = np.zeros((2),dtype=np.int32)
-    div_mask_acc = np.zeros((2),dtype=np.int32)
-    new_cells_acc = np.zeros((2),dtype=np.int32) 
-    new_cells_bbox_acc = np.zeros((2),dtype=np.int32) 
-    new_cells_mask_acc = np.zeros((2),dtype=np.int32)
+    device = outputs['pred_logits'].device
+    TP_bbox, TP_mask, FN, FP, FP_bbox, FP_mask = [torch.zeros((), dtype=torch.int64, device=device) for _ in range(6)]
+    div_acc, div_bbox_acc, div_mask_acc, new_cells_acc, new_cells_bbox_acc, new_cells_mask_acc = [torch.zeros((2), dtype=torch.int64, device=device) for _ in range(6)]
 
     for t,target in enumerate(targets):
         indices = target['indices']
@@ -522,129 +549,95 @@ def calc_track_acc(track_acc_dict,outputs,targets,args, calc_mask_acc=True):
         tgt_boxes = target['boxes']
 
         if target['empty']: # No objects to track
-            FP += int((pred_logits[:,0] > cls_thresh).sum())
+            FP += (pred_logits[:,0] > cls_thresh).sum()
             continue
 
         # Coutning False Positives; cells leaving the frame + False Positives added to the frame
-        pred_logits_FPs = pred_logits[~target['track_queries_TP_mask'] * target['track_queries_mask'],0]
-        FP += int((pred_logits_FPs > cls_thresh).sum())
+        pred_logits_FPs = pred_logits[:,0] * (~target['track_queries_TP_mask'] * target['track_queries_mask'])
+        FP += (pred_logits_FPs > cls_thresh).sum()
 
         if calc_mask_acc and 'pred_masks' in outputs:
             pred_masks = outputs['pred_masks'].sigmoid().detach()[t]
             tgt_masks = target['masks'].detach()
 
         # Calculate accuracy for new objects detected; FPs or TPs
-        for query_id in range(pred_logits.shape[0]):
-            if (~target['track_queries_mask'])[query_id]:
-                if query_id in indices[0]:
-                    ind_loc = torch.where(indices[0] == query_id)[0]
-                    if pred_logits[query_id,0] > cls_thresh:
-                        iou = box_ops.generalized_box_iou(
-                                box_ops.box_cxcywh_to_xyxy(pred_boxes[query_id,:4][None]),
-                                box_ops.box_cxcywh_to_xyxy(tgt_boxes[indices[1][ind_loc],:4]),
-                                return_iou_only=True
-                                )
-
-                        if iou > iou_thresh:
-                            TP_bbox += 1
-                            new_cells_bbox_acc += 1
-
-                        else:
-                            FP_bbox += 1       
-                            new_cells_bbox_acc[1] += 1  
-
-                        if calc_mask_acc and 'pred_masks' in outputs:
-                            pred_mask = pred_masks[query_id:query_id+1,:1]
-                            pred_mask_scaled = F.interpolate(pred_mask, size=tgt_masks.shape[-2:], mode="bilinear", align_corners=False)
-                            pred_mask_scaled = (pred_mask_scaled > 0.5) * 1.
-                            mask_iou = box_ops.mask_iou(pred_mask_scaled.flatten(1),tgt_masks[indices[1][ind_loc],:1].flatten(1))
+        object_queries = ~target['track_queries_mask']
+        detected = pred_logits[:,0] > cls_thresh
+        ind_out, ind_tgt = indices[0].to(device), indices[1].to(device)
+
+        # Unmatched object queries above the class threshold are FPs
+        unmatched = object_queries.clone()
+        unmatched[ind_out] = False
+        FP += (unmatched & detected).sum()
+
+        # Matches of object queries below the class threshold are FNs
+        new_object = object_queries[ind_out]
+        num_missed = (new_object & ~detected[ind_out]).sum()
+        FN += num_missed
+        new_cells_acc[1] += num_missed
+        new_detected = new_object & detected[ind_out]
+
+        correct = matched_box_iou(pred_boxes[ind_out,:4], tgt_boxes[ind_tgt,:4]) > iou_thresh
+        num_correct, num_scored = count_correct(new_detected, correct)
+        TP_bbox += num_correct
+        FP_bbox += num_scored - num_correct
+        new_cells_bbox_acc += torch.stack((num_correct, num_scored))
 
-                            if mask_iou > iou_thresh:
-                                TP_mask += 1
-                                new_cells_mask_acc += 1
-
-                            else:
-                                FP_mask += 1
-                                new_cells_mask_acc[1] += 1
-
-                    else:
-                        FN += 1
-                        new_cells_acc[1] += 1
-
-                else:
-                    if pred_logits[query_id,0] > cls_thresh:
-                        FP += 1
+        if calc_mask_acc and 'pred_masks' in outputs:
+            correct = matched_mask_iou(pred_masks[ind_out,:1], tgt_masks[ind_tgt,:1]) > iou_thresh
+            num_correct, num_scored = count_correct(new_detected, correct)
+            TP_mask += num_correct
+            FP_mask += num_scored - num_correct
+            new_cells_mask_acc += torch.stack((num_correct, num_scored))
 
         pred_track_logits = pred_logits[target['track_queries_TP_mask']]
         pred_track_boxes = pred_boxes[target['track_queries_TP_mask']]
         box_matching = target['track_query_match_ids']
 
-        if 'pred_masks' in outputs:
+        if calc_mask_acc and 'pred_masks' in outputs:
             pred_track_masks = pred_masks[target['track_queries_TP_mask']]
 
-        for p,pred_logit in enumerate(pred_track_logits):
-            if pred_logit[0] < cls_thresh:
-                FN += 1
+        # Tracked cells below the class threshold are FNs
+        tracked = pred_track_logits[:,0] >= cls_thresh
+        FN += (~tracked).sum()
 
-            else:
-                iou = box_ops.generalized_box_iou(
-                        box_ops.box_cxcywh_to_xyxy(pred_track_boxes[p:p+1,:4]),
-                        box_ops.box_cxcywh_to_xyxy(tgt_boxes[box_matching[p],:4][None]),
-                        return_iou_only=True
-                    )
-                
-                if iou > iou_thresh:
-                    TP_bbox += 1
-                else:
-                    FP_bbox += 1
+        correct = matched_box_iou(pred_track_boxes[:,:4], tgt_boxes[box_matching,:4]) > iou_thresh
+        num_correct, num_scored = count_correct(tracked, correct)
+        TP_bbox += num_correct
+        FP_bbox += num_scored - num_correct
 
-                if calc_mask_acc and 'pred_masks' in outputs:
-                    pred_mask = pred_track_masks[p:p+1,:1]
-                    pred_mask_scaled = F.interpolate(pred_mask, size=tgt_masks.shape[-2:], mode="bilinear", align_corners=False)
-                    pred_mask_scaled = (pred_mask_scaled > 0.5) * 1.
-                    mask_iou = box_ops.mask_iou(pred_mask_scaled.flatten(1),tgt_masks[box_matching[p],:1].flatten(1))
+        if calc_mask_acc and 'pred_masks' in outputs:
+            track_mask_correct = matched_mask_iou(pred_track_masks[:,:1], tgt_masks[box_matching,:1]) > iou_thresh
+            num_correct, num_scored = count_correct(tracked, track_mask_correct)
+            TP_mask += num_correct
+            FP_mask += num_scored - num_correct
+
+        # Need to check for divisions
+        pred_div = pred_track_logits[:,1]
+        tgt_div = tgt_boxes[box_matching,-1]
+        num_FP_div = ((pred_div > cls_thresh) & (tgt_div == 0)).sum() # Predicted FP division
+        num_FN_div = ((pred_div < cls_thresh) & (tgt_div > 0)).sum() # Predicted FN division
+        FP += num_FP_div
+        FN += num_FN_div
+        div_acc[1] += num_FP_div + num_FN_div
+
+        # Correctly predicted TP divisions; divided cells were not accounted above so we add them to correct & total column
+        TP_div = (pred_div > cls_thresh) & (tgt_div > 0)
+        correct = matched_box_iou(pred_track_boxes[:,4:], tgt_boxes[box_matching,4:]) > iou_thresh
+        num_correct, num_scored = count_correct(TP_div, correct)
+        TP_bbox += num_correct
+        FP_bbox += num_scored - num_correct
+        div_bbox_acc += torch.stack((num_correct, num_scored))
 
-                    if mask_iou > iou_thresh:
-                        TP_mask += 1
-                    else:
-                        FP_mask += 1
-
-            # Need to check for divisions
-            if pred_logit[1] > cls_thresh and tgt_boxes[box_matching[p],-1] == 0: # Predicted FP division
-                FP += 1  
-                div_acc[1] += 1           
-            elif pred_logit[1] < cls_thresh and tgt_boxes[box_matching[p],-1] > 0: # Predicted FN division
-                FN += 1
-                div_acc[1] += 1           
-            elif pred_logit[1] > cls_thresh and tgt_boxes[box_matching[p],-1] > 0: # Correctly predictly TP division
-                iou = box_ops.generalized_box_iou(
-                        box_ops.box_cxcywh_to_xyxy(pred_track_boxes[p:p+1,4:]),
-                        box_ops.box_cxcywh_to_xyxy(tgt_boxes[box_matching[p],4:][None]),
-                        return_iou_only=True
-                    )
-                # Divided cells were not accounted above so we add one to correct & total column
-                if iou > iou_thresh:
-                    TP_bbox += 1
-                    div_bbox_acc += 1
-                else:
-                    FP_bbox += 1
-                    div_bbox_acc[1] += 1
-
-                if calc_mask_acc and 'pred_masks' in outputs:
-                    pred_mask = pred_track_masks[p:p+1,:1]
-                    pred_mask_scaled = F.interpolate(pred_mask, size=tgt_masks.shape[-2:], mode="bilinear", align_corners=False)
-                    pred_mask_scaled = (pred_mask_scaled > 0.5) * 1.
-                    mask_iou = box_ops.mask_iou(pred_mask_scaled.flatten(1),tgt_masks[box_matching[p],:1].flatten(1))
-
-                    if mask_iou > iou_thresh:
-                        TP_mask += 1
-                        div_mask_acc += 1
-                    else:
-                        FP_mask += 1
-                        div_mask_acc[1] += 1
+        if calc_mask_acc and 'pred_masks' in outputs:
+            num_correct, num_scored = count_correct(TP_div, track_mask_correct)
+            TP_mask += num_correct
+            FP_mask += num_scored - num_correct
+            div_mask_acc += torch.stack((num_correct, num_scored))
 
-            elif pred_logit[1] > cls_thresh and tgt_boxes[box_matching[p],-1] == 0: # Predicted TN correctly
-                pass
+    TP_bbox, TP_mask, FN, FP, FP_bbox, FP_mask = torch.stack((TP_bbox, TP_mask, FN, FP, FP_bbox, FP_mask)).tolist()
+    div_acc, div_bbox_acc, div_mask_acc, new_cells_acc, new_cells_bbox_acc, new_cells_mask_acc = \
+        torch.stack((div_acc, div_bbox_acc, div_mask_acc, new_cells_acc, new_cells_bbox_acc, new_cells_mask_acc)).cpu().numpy().astype(np.int32)
 
     track_acc_dict['track_bbox_acc'] = np.array((TP_bbox,TP_bbox + FN + FP + FP_bbox),dtype=np.int32)[None,None]
     track_acc_dict['divisions_bbox_acc'] = (div_acc + div_bbox_acc)[None,None]
@@ -697,6 +690,23 @@ def point_sample(input, point_coords, **kwargs):
         output = output.squeeze(3)
     return output
 
+def remap_track_ids(track_ids, remaps):
+    '''
+    Applies a list of (old id, new id) replacements, in order, to track_ids in place.
+    The replacements are composed first so the tensor is only compared once.
+    '''
+    if len(remaps) == 0:
+        return
+
+    lookup = {}
+    for old_id, new_id in remaps:
+        lookup = {key: new_id if value == old_id else value for key, value in lookup.items()}
+        lookup.setdefault(old_id, new_id)
+
+    match = track_ids.unsqueeze(-1) == track_ids.new_tensor(list(lookup.keys()))
+    track_ids.copy_(torch.where(match.any(-1), (match * track_ids.new_tensor(list(lookup.values()))).sum(-1), track_ids))
+
+
 def man_track_ids(targets,training_method:str,input_target_name:str,output_target_name:str = None):
 
     target_names = ['prev_prev_target','prev_target','cur_target','fut_target']
@@ -718,12 +728,11 @@ def man_track_ids(targets,training_method:str,input_target_name:str,output_targe
                 if 'new_cell_ids' in target[training_method][target_name]: # This is necessary for dn_track and dn_track_group; it removes newly detected cells since we only care about tracking here
                     remove_track_ids = target[training_method][target_name]['new_cell_ids']
                     track_ids_orig = target[training_method][target_name]['track_ids_orig']
+                    remove_indices = torch.isin(track_ids_orig, torch.as_tensor(remove_track_ids, device=track_ids_orig.device))
 
-                    for remove_track_id in remove_track_ids:
-                        remove_indices |= (track_ids_orig == remove_track_id)
-
+                keep_ind = (~remove_indices).nonzero().squeeze(1)
                 for feature in features:
-                    target[training_method][target_name][feature] = target[training_method][target_name][feature + '_orig'][~remove_indices].clone()
+                    target[training_method][target_name][feature] = target[training_method][target_name][feature + '_orig'].index_select(0, keep_ind)
        
         input_target = target[training_method][input_target_name]
         output_target = target[training_method][output_target_name]
@@ -744,73 +753,86 @@ def man_track_ids(targets,training_method:str,input_target_name:str,output_targe
             else:
                 target_ind_matching = output_target['target_ind_matching'][:-output_target['num_FPs']]
 
-        man_track = target[training_method]['man_track'].clone()
+        man_track = target[training_method]['man_track']
         man_track = man_track[(man_track[:,1] <= framenb) * (man_track[:,2] >= framenb)]
         
         # cell_divisions = man_track[:,-1]
         cell_divisions = man_track[:,-1] * (man_track[:,1] == framenb) # only check for divisions that occur in the current frame
 
-        for idx,prev_track_id in enumerate(prev_track_ids):
-            if 'target_ind_matching' in output_target and not target_ind_matching[idx]:
-                continue # This is necesary for when FN are added; the model is forced to detect the cell instead of tracking it
+        # Previous cells that don't track to the next frame but divided in it
+        div_prev_cells = ~torch.isin(prev_track_ids, output_target['track_ids_orig']) & torch.isin(prev_track_ids, cell_divisions)
+
+        if 'target_ind_matching' in output_target:
+            div_prev_cells &= target_ind_matching.bool() # This is necesary for when FN are added; the model is forced to detect the cell instead of tracking it
 
-            if prev_track_id not in output_target['track_ids_orig']: # If cell does not track to next frame
-                if prev_track_id in cell_divisions: # check if cell divided
+        fut_remaps = []
 
-                    div_cur_track_ids = man_track[man_track[:,-1] == prev_track_id,0]
+        for idx in div_prev_cells.nonzero()[:,0].tolist():
+            prev_track_id = prev_track_ids[idx]
 
-                    if len(div_cur_track_ids) == 2:
+            div_cur_track_ids = man_track[man_track[:,-1] == prev_track_id,0]
 
-                        div_ind_1 = output_target['track_ids'] == div_cur_track_ids[0]
-                        div_ind_2 = output_target['track_ids'] == div_cur_track_ids[1]
+            if len(div_cur_track_ids) == 2:
 
-                        if div_ind_1.sum() == 1 and div_ind_2.sum() == 1:
+                div_ind_1 = output_target['track_ids'] == div_cur_track_ids[0]
+                div_ind_2 = output_target['track_ids'] == div_cur_track_ids[1]
+                num_div_1, num_div_2 = div_ind_1.sum().item(), div_ind_2.sum().item()
 
-                            output_target['track_ids'][div_ind_1] = prev_track_id
-                            remove_ind = output_target['track_ids'] != div_cur_track_ids[1]         
+                if num_div_1 == 1 and num_div_2 == 1:
 
-                            for feature in features:
-                                if feature not in ['flexible_divisions','track_ids','is_touching_edge']:
-                                    feature_len = output_target[feature].shape[1]
-                                    output_target[feature][div_ind_1,feature_len//2:] = output_target[feature][div_ind_2,:feature_len//2]
-                                
-                                if feature == 'is_touching_edge' and output_target['is_touching_edge'][div_ind_2]:
-                                    output_target['is_touching_edge'][div_ind_1] = True
+                    output_target['track_ids'].masked_fill_(div_ind_1, prev_track_id)
+                    remove_ind = output_target['track_ids'] != div_cur_track_ids[1]         
 
-                                output_target[feature] = output_target[feature][remove_ind]
+                    for feature in features:
+                        if feature not in ['flexible_divisions','track_ids','is_touching_edge']:
+                            feature_len = output_target[feature].shape[1]
+                            output_target[feature][div_ind_1,feature_len//2:] = output_target[feature][div_ind_2,:feature_len//2]
+                        
+                        if feature == 'is_touching_edge' and output_target['is_touching_edge'][div_ind_2]:
+                            output_target['is_touching_edge'][div_ind_1] = True
 
-                        elif div_ind_1.sum() == 1 or div_ind_2.sum() == 1:
+                        output_target[feature] = output_target[feature][remove_ind]
 
-                            if div_ind_1.sum() == 1:
-                                div_ind = div_ind_1
-                                div_ind_orig = output_target['track_ids_orig'] == div_cur_track_ids[0]
-                            else:
-                                div_ind = div_ind_2
-                                div_ind_orig = output_target['track_ids_orig'] == div_cur_track_ids[1]
-                                div_cur_track_ids = torch.flip(div_cur_track_ids,dims=[0])
+                elif num_div_1 == 1 or num_div_2 == 1:
 
-                            assert div_ind_orig.sum() == 1
-                            output_target['track_ids'][div_ind] = prev_track_id
-                            output_target['track_ids_orig'][div_ind_orig] = prev_track_id
+                    if num_div_1 == 1:
+                        div_ind = div_ind_1
+                        div_ind_orig = output_target['track_ids_orig'] == div_cur_track_ids[0]
+                    else:
+                        div_ind = div_ind_2
+                        div_ind_orig = output_target['track_ids_orig'] == div_cur_track_ids[1]
+                        div_cur_track_ids = torch.flip(div_cur_track_ids,dims=[0])
 
-                            assert target[training_method]['man_track'][target[training_method]['man_track'][:,0] == prev_track_id,2] == framenb-1
+                    assert div_ind_orig.sum() == 1
+                    output_target['track_ids'].masked_fill_(div_ind, prev_track_id)
+                    output_target['track_ids_orig'].masked_fill_(div_ind_orig, prev_track_id)
 
-                            # Have mother cell replace daughter cell that is still in frame 
-                            dau_cells = target[training_method]['man_track'][target[training_method]['man_track'][:,-1] == div_cur_track_ids[0],0]
-                            target[training_method]['man_track'][target[training_method]['man_track'][:,0] == dau_cells,-1] = prev_track_id
-                            target[training_method]['man_track'][target[training_method]['man_track'][:,0] == prev_track_id,2] = target[training_method]['man_track'][target[training_method]['man_track'][:,0] == div_cur_track_ids[0],2] 
-                            
-                            target[training_method]['man_track'][target[training_method]['man_track'][:,0] == div_cur_track_ids[0],1:] = -1 # remove cell from lineage since the mother cell replaced it
-                            target[training_method]['man_track'][target[training_method]['man_track'][:,0] == div_cur_track_ids[1],-1] = 0 # remove division track from other cell
+                    full_man_track = target[training_method]['man_track']
+                    is_prev_cell = full_man_track[:,0] == prev_track_id
+                    is_dau_cell = full_man_track[:,0] == div_cur_track_ids[0]
 
-                            for future_target_name in future_target_names:
-                                fut_target = target[training_method][future_target_name]
-                                fut_target['track_ids'][fut_target['track_ids'] == div_cur_track_ids[0]] = prev_track_id
-                                fut_target['track_ids_orig'][fut_target['track_ids_orig'] == div_cur_track_ids[0]] = prev_track_id
-                            
-                    else:
-                        raise NotImplementedError
+                    assert full_man_track[is_prev_cell,2] == framenb-1
 
+                    # Have mother cell replace daughter cell that is still in frame 
+                    dau_cells = full_man_track[full_man_track[:,-1] == div_cur_track_ids[0],0]
+                    full_man_track[full_man_track[:,0] == dau_cells,-1] = prev_track_id
+                    full_man_track[is_prev_cell,2] = full_man_track[is_dau_cell,2] 
+                    
+                    full_man_track[is_dau_cell,1:] = -1 # remove cell from lineage since the mother cell replaced it
+                    full_man_track[full_man_track[:,0] == div_cur_track_ids[1],-1] = 0 # remove division track from other cell
+
+                    fut_remaps.append((div_cur_track_ids[0].item(), prev_track_id.item()))
+                    
+            else:
+                raise NotImplementedError
+
+        for future_target_name in future_target_names:
+            fut_target = target[training_method][future_target_name]
+            remap_track_ids(fut_target['track_ids'], fut_remaps)
+            remap_track_ids(fut_target['track_ids_orig'], fut_remaps)
+
+        # Sanity check only, run when at least one previous cell was considered
+        if __debug__ and len(prev_track_ids) > 0 and ('target_ind_matching' not in output_target or target_ind_matching.any()):
             removed_cells_input = 0 
             removed_cells_output = 0 
 
@@ -824,9 +846,9 @@ def man_track_ids(targets,training_method:str,input_target_name:str,output_targe
 
     for target_name in target_names:
         if len(target[training_method][target_name]['track_ids'].shape) == 1:
-            for track_id in target[training_method][target_name]['track_ids']:
-                if track_id not in target[training_method]['man_track'][:,0]:
-                    raise NotImplementedError
+            cell_ids = set(target[training_method]['man_track'][:,0].tolist())
+            if not cell_ids.issuperset(target[training_method][target_name]['track_ids'].tolist()):
+                raise NotImplementedError
 
     return targets
 
@@ -844,60 +866,77 @@ def update_cropped_man_track(target):
     man_track = target['man_track']
     max_cellnb = target['man_track'][-1,0].item()
 
+    # Row of each cell id; ids are never rewritten and new cells are appended
+    id_to_row = {cell_id: row for row, cell_id in enumerate(man_track[:,0].tolist())}
+    # Ids in each frame; kept in sync with every write to track_ids below
+    track_id_sets = {target_name: set(target[target_name]['track_ids'].tolist()) for target_name in target_names}
+
     for target_name in target_names:
 
         output_target_index = target_names.index(target_name)
         future_target_names = [output_target_name for output_target_name in target_names if target_names.index(output_target_name) > output_target_index]
 
-        framenb = target[target_name]['framenb']
+        frame_target = target[target_name]
+        framenb = frame_target['framenb']
+
+        # Only cells alive in this frame but missing from the crop need updating
+        track_ids = man_track[(man_track[:,1] <= framenb) * (man_track[:,2] >= framenb),0].tolist()
+        track_ids = [track_id for track_id in track_ids if track_id not in track_id_sets[target_name]]
 
-        track_ids = man_track[(man_track[:,1] <= framenb) * (man_track[:,2] >= framenb),0]
+        fut_remaps = {future_target_name: [] for future_target_name in future_target_names}
 
         for track_id in track_ids:
 
-            cell_track = man_track[man_track[:,0] == track_id][0]
-            # if cell is not in cropped frame and it wasn't just born
-            if track_id not in target[target_name]['track_ids'] and man_track[man_track[:,0] == track_id,1] != -1:
+            row = id_to_row[track_id]
+            cell_track = man_track[row].clone()
+            # if cell wasn't just born
+            if man_track[row,1] != -1:
 
                 # If one of cells that divided are not present in frame, assume no division occured
                 if cell_track[-1] > 0 and cell_track[1] == framenb:
-                    other_dau_id = man_track[(man_track[:,-1] == cell_track[-1]) * (man_track[:,0] != track_id),0].item()
+                    sibling_mask = man_track[:,-1] == cell_track[-1]
+                    sibling_mask[row] = False
+                    other_dau_id = man_track[sibling_mask,0].item()
+                    other_dau_row = id_to_row[other_dau_id]
 
-                    man_track[man_track[:,0] == other_dau_id,-1] = 0
-                    man_track[man_track[:,0] == track_id,-1] = 0
+                    man_track[other_dau_row,-1] = 0
+                    man_track[row,-1] = 0
 
-                    if other_dau_id in target[target_name]['track_ids']:
+                    if other_dau_id in track_id_sets[target_name]:
 
                         mother_id = cell_track[-1]
 
-                        div_ind = target[target_name]['track_ids'] == other_dau_id
-                        div_ind_orig = target[target_name]['track_ids_orig'] == other_dau_id
+                        div_ind = frame_target['track_ids'] == other_dau_id
+                        div_ind_orig = frame_target['track_ids_orig'] == other_dau_id
                         assert div_ind.sum() == 1 and div_ind_orig.sum() == 1
-                        target[target_name]['track_ids'][div_ind] = mother_id   
-                        target[target_name]['track_ids_orig'][div_ind_orig] = mother_id
+                        frame_target['track_ids'].masked_fill_(div_ind, mother_id)
+                        frame_target['track_ids_orig'].masked_fill_(div_ind_orig, mother_id)
+                        track_id_sets[target_name].discard(other_dau_id)
+                        track_id_sets[target_name].add(mother_id.item())
 
                         # Have mother cell replace daughter cell that is still in frame 
                         dau_cells = man_track[man_track[:,-1] == other_dau_id,0]
                         if len(dau_cells) > 0:
-                            man_track[man_track[:,0] == dau_cells[0],-1] = mother_id
-                            man_track[man_track[:,0] == dau_cells[1],-1] = mother_id
+                            man_track[id_to_row[dau_cells[0].item()],-1] = mother_id
+                            man_track[id_to_row[dau_cells[1].item()],-1] = mother_id
                             
-                        man_track[man_track[:,0] == mother_id,2] = man_track[man_track[:,0] == other_dau_id,2] 
+                        man_track[id_to_row[mother_id.item()],2] = man_track[other_dau_row,2] 
                         
-                        man_track[man_track[:,0] == other_dau_id,1:] = -1 # remove cell from lineage since the mother cell replaced it
-                        man_track[man_track[:,0] == track_id,1] = framenb+1 # remove cell from lineage since the mother cell replaced it
+                        man_track[other_dau_row,1:] = -1 # remove cell from lineage since the mother cell replaced it
+                        man_track[row,1] = framenb+1 # remove cell from lineage since the mother cell replaced it
 
                         for future_target_name in future_target_names:
-                            fut_target = target[future_target_name]
-                            fut_target['track_ids'][fut_target['track_ids'] == other_dau_id] = mother_id
-                            fut_target['track_ids_orig'][fut_target['track_ids_orig'] == other_dau_id] = mother_id
+                            fut_remaps[future_target_name].append((other_dau_id, mother_id.item()))
+                            if other_dau_id in track_id_sets[future_target_name]:
+                                track_id_sets[future_target_name].discard(other_dau_id)
+                                track_id_sets[future_target_name].add(mother_id.item())
                         
                     else:
-                        man_track[man_track[:,0] == other_dau_id,1] = framenb + 1
-                        man_track[man_track[:,0] == track_id,1] = framenb + 1
+                        man_track[other_dau_row,1] = framenb + 1
+                        man_track[row,1] = framenb + 1
 
-                        if man_track[man_track[:,0] == other_dau_id,2] < man_track[man_track[:,0] == other_dau_id,1]:
-                            man_track[man_track[:,0] == other_dau_id,1:] = -1
+                        if man_track[other_dau_row,2] < man_track[other_dau_row,1]:
+                            man_track[other_dau_row,1:] = -1
                             man_track[man_track[:,-1] == other_dau_id,-1] = 0
 
                 else:
@@ -907,46 +946,53 @@ def update_cropped_man_track(target):
                         fut_target = target[future_target_name]
                         fut_framenb = target[future_target_name]['framenb'].item()
 
-                        if track_id in fut_target['track_ids']:
+                        if track_id in track_id_sets[future_target_name]:
 
                             if new_cell:
                                 max_cellnb += 1
 
-                                exit_framenb = man_track[man_track[:,0] == track_id,2][0]
-                                new_cell = torch.tensor([[max_cellnb,fut_framenb,exit_framenb,0]]).to(man_track.device)
+                                # Appended right away since the lookups below need the new row
+                                exit_framenb = man_track[row,2].item()
+                                new_cell = man_track.new_tensor([[max_cellnb,fut_framenb,exit_framenb,0]])
                                 man_track = torch.cat((man_track,new_cell))
-                                man_track[man_track[:,0] == track_id,2] = framenb-1
+                                id_to_row[max_cellnb] = len(man_track) - 1
+                                man_track[row,2] = framenb-1
 
                                 dau_cells = man_track[man_track[:,-1] == track_id,0]
 
                                 if len(dau_cells) > 0:
-                                    man_track[man_track[:,0] == dau_cells[0],-1] = max_cellnb
-                                    man_track[man_track[:,0] == dau_cells[1],-1] = max_cellnb
+                                    man_track[id_to_row[dau_cells[0].item()],-1] = max_cellnb
+                                    man_track[id_to_row[dau_cells[1].item()],-1] = max_cellnb
                                 new_cell = False
 
                             assert track_id in fut_target['track_ids'] and track_id in fut_target['track_ids_orig']
 
-                            fut_target['track_ids'][fut_target['track_ids'] == track_id] = max_cellnb
-                            fut_target['track_ids_orig'][fut_target['track_ids_orig'] == track_id] = max_cellnb
+                            fut_remaps[future_target_name].append((track_id, max_cellnb))
+                            track_id_sets[future_target_name].discard(track_id)
+                            track_id_sets[future_target_name].add(max_cellnb)
                         else:
                             new_cell = True
 
-                    man_track[man_track[:,0] == track_id,2] = framenb - 1 
+                    man_track[row,2] = framenb - 1 
 
                     if track_id in man_track[:,-1]:
                         dau_cells = man_track[man_track[:,-1] == track_id,0]
                         if len(dau_cells) > 0:
-                            man_track[man_track[:,0] == dau_cells[0],-1] = 0                                           
-                            man_track[man_track[:,0] == dau_cells[1],-1] = 0                                           
+                            man_track[id_to_row[dau_cells[0].item()],-1] = 0                                           
+                            man_track[id_to_row[dau_cells[1].item()],-1] = 0                                           
                 
-                if man_track[man_track[:,0] == track_id,2] < man_track[man_track[:,0] == track_id,1]:
-                    man_track[man_track[:,0] == track_id,1:] = -1
+                if man_track[row,2] < man_track[row,1]:
+                    man_track[row,1:] = -1
                     man_track[man_track[:,-1] == track_id,-1] = 0
 
                     dau_cells = man_track[man_track[:,-1] == track_id,0]
                     if len(dau_cells) > 0:
-                        man_track[man_track[:,0] == dau_cells[0],-1] = 0
-                        man_track[man_track[:,0] == dau_cells[1],-1] = 0
+                        man_track[id_to_row[dau_cells[0].item()],-1] = 0
+                        man_track[id_to_row[dau_cells[1].item()],-1] = 0
+
+        for future_target_name in future_target_names:
+            remap_track_ids(target[future_target_name]['track_ids'], fut_remaps[future_target_name])
+            remap_track_ids(target[future_target_name]['track_ids_orig'], fut_remaps[future_target_name])
                     
     target['man_track'] = man_track
 
@@ -958,30 +1004,20 @@ def split_outputs(outputs,target_TM):
     start_ind = target_TM['start_query_ind']
     end_ind = target_TM['end_query_ind']
 
-    new_outputs = {}
-    
-    if new_outputs is None:
-        new_outputs = outputs
-    new_outputs['pred_logits'] = outputs['pred_logits'][:,start_ind:end_ind]
-    new_outputs['pred_boxes'] = outputs['pred_boxes'][:,start_ind:end_ind]
+    keys = ['pred_logits','pred_boxes','pred_masks']
 
-    if 'pred_masks' in outputs:
-        new_outputs['pred_masks'] = outputs['pred_masks'][:,start_ind:end_ind]
+    new_outputs = {key: outputs[key][:,start_ind:end_ind] for key in keys if key in outputs}
 
     if 'aux_outputs' in outputs:
-
-        new_outputs['aux_outputs'] = [{} for _ in range(len(outputs['aux_outputs']))]
-
-        for lid in range(len(outputs['aux_outputs'])):
-            new_outputs['aux_outputs'][lid]['pred_logits'] = outputs['aux_outputs'][lid]['pred_logits'][:,start_ind:end_ind]
-            new_outputs['aux_outputs'][lid]['pred_boxes'] = outputs['aux_outputs'][lid]['pred_boxes'][:,start_ind:end_ind]
-
-            if 'pred_masks' in outputs['aux_outputs'][lid]:
-                new_outputs['aux_outputs'][lid]['pred_masks'] = outputs['aux_outputs'][lid]['pred_masks'][:,start_ind:end_ind]
+        new_outputs['aux_outputs'] = [{key: aux_outputs[key][:,start_ind:end_ind] for key in keys if key in aux_outputs} for aux_outputs in outputs['aux_outputs']]
 
     return new_outputs
 
 
+# "Epoch N: H:M:S" lines written by train.py after every epoch
+# str(timedelta) prefixes "N day(s), " once an epoch runs for 24 hours or more
+EPOCH_TIME_RE = re.compile(r': (?:(\d+) days?, )?(\d+):(\d+):(\d+)\s*$', re.M)
+
 def get_total_time(args):
 
     total_time = datetime.timedelta()
@@ -989,18 +1025,17 @@ def get_total_time(args):
     if not (args.output_dir / "training_time.txt").exists():
         return str(total_time)
 
-    with open(str(args.output_dir / "training_time.txt"), 'r') as file:
-        for line in file:
-            if line.strip():  # Check if line is not empty
-                if "Total time:" in line:
-                    return str(total_time)
-                
-                _, time_str = line.split(': ')
-                hours, minutes, seconds = map(int, time_str.split(':'))
-                total_time += datetime.timedelta(hours=hours, minutes=minutes, seconds=seconds)
+    text = (args.output_dir / "training_time.txt").read_text()
+
+    # Only epochs before an existing total are counted, in which case nothing new is written
+    text, total_written, _ = text.partition("Total time:")
+
+    seconds = sum(int(days or 0) * 86400 + int(hours) * 3600 + int(minutes) * 60 + int(secs) for days, hours, minutes, secs in EPOCH_TIME_RE.findall(text))
+    total_time = datetime.timedelta(seconds=seconds)
 
-    with open(str(args.output_dir / "training_time.txt"), "a") as f:
-        f.write(f"Total time: {total_time}\n")
+    if not total_written:
+        with open(str(args.output_dir / "training_time.txt"), "a") as f:
+            f.write(f"Total time: {total_time}\n")
 
     return str(total_time)
 
@@ -1080,7 +1115,7 @@ def load_model(model_without_ddp,args,param_dicts=None,optimizer=None,lr_schedul
             elif 'linear2' in k or 'input_proj' in k:
                 resume_value = checkpoint_value.repeat((2,) + (num_dims - 1) * (1, ))
             elif 'class_embed' in k:
-                resume_value = checkpoint_value[list(range(0, 20))]
+                resume_value = checkpoint_value[:20].clone()
             else:
                 raise NotImplementedError(f"No rule for {k} with shape {v.shape}.")
 
@@ -1148,10 +1183,12 @@ def add_new_targets_from_main(targets,training_method,target_name):
         target[training_method] = {'training_method': training_method, target_name: {}}
 
         for key in keys:
-            target[training_method][target_name][key] = target['main'][target_name][key + '_orig'].clone()
-            target[training_method][target_name][key + '_orig'] = target['main'][target_name][key + '_orig'].clone()
+            orig = target['main'][target_name][key + '_orig']
+            target[training_method][target_name][key] = orig.clone()
+            # labels_orig is never written in place, so it can share main's tensor
+            target[training_method][target_name][key + '_orig'] = orig if key == 'labels' else orig.clone()
 
-        target[training_method][target_name]['empty'] = target['main'][target_name]['empty'].clone()
+        target[training_method][target_name]['empty'] = target['main'][target_name]['empty']
 
         # This is needed for flex div for OD; could do this for two-stage encoder as well
         target[training_method]['man_track'] = target['main']['man_track'].clone()
@@ -1207,6 +1244,16 @@ def plot_loss_and_metrics(datapath):
     ax.set_yscale('log')
     plt.savefig(datapath / 'loss_plot_overall_log.png')
 
+    # Each loss curve is computed once and reused
+    loss_curves = {}
+    datasets = {'train': metrics_train, 'val': metrics_val}
+
+    def loss_curve(dataset, key):
+        if (dataset, key) not in loss_curves:
+            has_data = ~np.isnan(datasets[dataset][key]).all(-1)
+            loss_curves[(dataset, key)] = (np.arange(1,epochs+1)[has_data], np.nanmean(datasets[dataset][key][has_data],axis=-1))
+        return loss_curves[(dataset, key)]
+
     # Plot the individual losses
     fig,ax = plt.subplots(len(training_methods),2,figsize=(10,15))
 
@@ -1220,17 +1267,11 @@ def plot_loss_and_metrics(datapath):
         t = [i for i in range(len(training_methods)) if training_methods[i] in loss and (loss[len(training_methods[i]): len(training_methods[i]) + 6] != '_group')][0]
         training_method = training_methods[t]
 
-        plot_epochs_train = np.arange(1,epochs+1)
-        plot_epochs_val = np.arange(1,epochs+1)
-        plot_epochs_train = plot_epochs_train[~np.isnan(metrics_train[loss]).all(-1)]
-        plot_epochs_val = plot_epochs_val[~np.isnan(metrics_val[loss]).all(-1)]
-        plot_metrics_train = metrics_train[loss][~np.isnan(metrics_train[loss]).all(-1)]
-        plot_metrics_val = metrics_val[loss][~np.isnan(metrics_val[loss]).all(-1)]
+        plot_epochs_train, train_loss = loss_curve('train', loss)
+        plot_epochs_val, val_loss = loss_curve('val', loss)
 
         label = loss.replace(training_method + '_','')
 
-        train_loss = np.nanmean(plot_metrics_train,axis=-1)
-        val_loss = np.nanmean(plot_metrics_val,axis=-1)
         ax[t,0].plot(plot_epochs_train,train_loss,label=label)
         ax[t,1].plot(plot_epochs_val,val_loss,label=label)
         min_y = min((min_y,min(train_loss),min(val_loss)))
@@ -1288,7 +1329,8 @@ def plot_loss_and_metrics(datapath):
             fig,ax = plt.subplots(len(losses_TM),2,figsize=(10,len(losses_TM)*3))
             min_y = np.inf
             max_y = 0
-            layer_nbs = [''] + [f'_{i:1d}' for i in range(num_layers)]
+            # CoMOT only has intermediate losses
+            layer_nbs = ([''] if training_method != 'CoMOT' else []) + [f'_{i:1d}' for i in range(num_layers)]
             for i,loss in enumerate(losses_TM):
 
                 if 'CoMOT_loss_ce' in loss and np.isnan(metrics_train['CoMOT_loss_ce_0']).all():
@@ -1296,19 +1338,10 @@ def plot_loss_and_metrics(datapath):
                     
                 for layer_nb in layer_nbs:
 
-                    if layer_nb == '' and training_method == 'CoMOT':
-                        continue
-
                     loss_key = loss + layer_nb
 
-                    plot_epochs_train = np.arange(1,epochs+1)
-                    plot_epochs_val = np.arange(1,epochs+1)
-                    plot_epochs_train = plot_epochs_train[~np.isnan(metrics_train[loss_key]).all(-1)]
-                    plot_epochs_val = plot_epochs_val[~np.isnan(metrics_val[loss_key]).all(-1)]
-                    plot_metrics_train = metrics_train[loss_key][~np.isnan(metrics_train[loss_key]).all(-1)]
-                    plot_metrics_val = metrics_val[loss_key][~np.isnan(metrics_val[loss_key]).all(-1)]
-                    train_loss = np.nanmean(plot_metrics_train,axis=-1)
-                    val_loss = np.nanmean(plot_metrics_val,axis=-1)
+                    plot_epochs_train, train_loss = loss_curve('train', loss_key)
+                    plot_epochs_val, val_loss = loss_curve('val', loss_key)
                     ax[i,0].plot(plot_epochs_train,train_loss,label=loss_key)
                     ax[i,1].plot(plot_epochs_val,val_loss,label=loss_key)
                     min_y = min((min_y,np.nanmin(train_loss),np.nanmin(val_loss)))
@@ -1330,6 +1363,14 @@ def plot_loss_and_metrics(datapath):
     fig,ax = plt.subplots(1,len(metrics)//2,figsize=(20,5))
     colors = ['k','b']
     metrics_txt = []
+    replace_words = ['det_','track_','divisions_','new_cells_not_edge_','new_cells_']
+
+    # Fraction correct per epoch; empty epochs give 0
+    def acc_ratio(acc):
+        acc = np.nansum(acc,axis=-2)
+        return acc[:,0] / np.maximum(acc[:,1],1)
+
+    acc_ratios = {metric: (acc_ratio(metrics_train[metric]),acc_ratio(metrics_val[metric])) for metric in metrics}
 
     for midx,metric in enumerate(metrics):
 
@@ -1342,12 +1383,7 @@ def plot_loss_and_metrics(datapath):
         else:
             i = 3
 
-        replace_words = ['det_','track_','divisions_','new_cells_not_edge_','new_cells_']
-        
-        train_acc = np.nansum(metrics_train[metric],axis=-2)
-        train_acc = train_acc[:,0] / np.maximum(train_acc[:,1],1)
-        val_acc = np.nansum(metrics_val[metric],axis=-2)
-        val_acc = val_acc[:,0] / np.maximum(val_acc[:,1],1)
+        train_acc, val_acc = acc_ratios[metric]
 
         label_metric = metric.replace(replace_words[i],'')
         label_metric = label_metric.replace('_acc','')
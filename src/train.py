@@ -132,6 +132,7 @@ def train(respath, dataset) -> None:
         batch_sampler=batch_sampler_train,
         collate_fn=utils.collate_fn,
         num_workers=args.num_workers,
+        pin_memory=device.type == 'cuda',
         worker_init_fn=seed_worker)
 
     data_loader_val = DataLoader(
@@ -140,6 +141,7 @@ def train(respath, dataset) -> None:
         drop_last=False,
         collate_fn=utils.collate_fn,
         num_workers=args.num_workers,
+        pin_memory=device.type == 'cuda',
         worker_init_fn=seed_worker)
 
     if args.resume:
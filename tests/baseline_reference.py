@@ -0,0 +1,299 @@
+"""
+Baseline implementations kept verbatim as references for the parity tests.
+"""
+import torch
+
+
+def masks_to_boxes(masks,cxcywh=False):
+    """Compute the bounding boxes around the provided masks
+
+    The masks should be in format [N, H, W] where N is the number of masks, (H, W) are the spatial dimensions.
+
+    Returns a [N, 4] tensors, with the boxes in xyxy format
+    """
+    if masks.numel() == 0:
+        return torch.zeros((0, 4), device=masks.device)
+
+    h, w = masks.shape[-2:]
+
+    y = torch.arange(0, h, dtype=torch.float, device=masks.device)
+    x = torch.arange(0, w, dtype=torch.float, device=masks.device)
+    y, x = torch.meshgrid(y, x)
+
+    x_mask = (masks * x.unsqueeze(0))
+    x_max = x_mask.flatten(1).max(-1)[0]
+    x_min = x_mask.masked_fill(~(masks.bool()), 1e8).flatten(1).min(-1)[0]
+
+    y_mask = (masks * y.unsqueeze(0))
+    y_max = y_mask.flatten(1).max(-1)[0]
+    y_min = y_mask.masked_fill(~(masks.bool()), 1e8).flatten(1).min(-1)[0]
+
+
+    if cxcywh:
+        boxes = torch.stack([(x_min+x_max)/2/w, (y_min+y_max)/2/h, (x_max-x_min)/w, (y_max-y_min)/h], 1)
+    else:
+        boxes = torch.stack([x_min, y_min, x_max, y_max], 1)
+
+    boxes[masks.sum((1,2)) == 0] = torch.tensor([0,0,0,0],dtype=boxes.dtype,device=masks.device)
+
+    if cxcywh:
+        assert (boxes[::2] > 1).sum() == 0 and (boxes[1::2] > 1).sum() == 0
+    else:
+        assert (boxes[::2] > w).sum() == 0 and (boxes[1::2] > h).sum() == 0
+    return boxes
+
+
+def man_track_ids(targets,training_method:str,input_target_name:str,output_target_name:str = None):
+
+    target_names = ['prev_prev_target','prev_target','cur_target','fut_target']
+    target_names = [target_name for target_name in target_names if target_name in targets[0][training_method]]
+
+    output_target_index = target_names.index(output_target_name)
+    future_target_names = [target_name for target_name in target_names if target_names.index(target_name) > output_target_index]
+
+    features = ['track_ids','boxes','labels','flexible_divisions','is_touching_edge']
+    if 'masks' in targets[0][training_method][output_target_name]:
+        features += ['masks']
+
+    for target in targets:
+        for target_name in target_names:
+            
+            if not target[training_method][target_name]['empty']: # when there are no cells, formatting is weird for empty images. need to fix this in the future
+                remove_indices = torch.zeros_like(target[training_method][target_name]['track_ids_orig']).bool()
+                
+                if 'new_cell_ids' in target[training_method][target_name]: # This is necessary for dn_track and dn_track_group; it removes newly detected cells since we only care about tracking here
+                    remove_track_ids = target[training_method][target_name]['new_cell_ids']
+                    track_ids_orig = target[training_method][target_name]['track_ids_orig']
+
+                    for remove_track_id in remove_track_ids:
+                        remove_indices |= (track_ids_orig == remove_track_id)
+
+                for feature in features:
+                    target[training_method][target_name][feature] = target[training_method][target_name][feature + '_orig'][~remove_indices].clone()
+       
+        input_target = target[training_method][input_target_name]
+        output_target = target[training_method][output_target_name]
+
+        if input_target['empty'] or output_target['empty']:
+            continue
+        
+        framenb = output_target['framenb']
+        prev_track_ids = input_target['track_ids']
+
+        if 'prev_ind' in output_target:
+            prev_track_ids = prev_track_ids[output_target['prev_ind'][1]]
+
+        # This is needed if false negatives are added or tracks are removed. So groundtruths exist but need to be ignored
+        if 'target_ind_matching' in output_target:
+            if output_target['num_FPs'] == 0:
+                target_ind_matching = output_target['target_ind_matching']
+            else:
+                target_ind_matching = output_target['target_ind_matching'][:-output_target['num_FPs']]
+
+        man_track = target[training_method]['man_track'].clone()
+        man_track = man_track[(man_track[:,1] <= framenb) * (man_track[:,2] >= framenb)]
+        
+        # cell_divisions = man_track[:,-1]
+        cell_divisions = man_track[:,-1] * (man_track[:,1] == framenb) # only check for divisions that occur in the current frame
+
+        for idx,prev_track_id in enumerate(prev_track_ids):
+            if 'target_ind_matching' in output_target and not target_ind_matching[idx]:
+                continue # This is necesary for when FN are added; the model is forced to detect the cell instead of tracking it
+
+            if prev_track_id not in output_target['track_ids_orig']: # If cell does not track to next frame
+                if prev_track_id in cell_divisions: # check if cell divided
+
+                    div_cur_track_ids = man_track[man_track[:,-1] == prev_track_id,0]
+
+                    if len(div_cur_track_ids) == 2:
+
+                        div_ind_1 = output_target['track_ids'] == div_cur_track_ids[0]
+                        div_ind_2 = output_target['track_ids'] == div_cur_track_ids[1]
+
+                        if div_ind_1.sum() == 1 and div_ind_2.sum() == 1:
+
+                            output_target['track_ids'][div_ind_1] = prev_track_id
+                            remove_ind = output_target['track_ids'] != div_cur_track_ids[1]         
+
+                            for feature in features:
+                                if feature not in ['flexible_divisions','track_ids','is_touching_edge']:
+                                    feature_len = output_target[feature].shape[1]
+                                    output_target[feature][div_ind_1,feature_len//2:] = output_target[feature][div_ind_2,:feature_len//2]
+                                
+                                if feature == 'is_touching_edge' and output_target['is_touching_edge'][div_ind_2]:
+                                    output_target['is_touching_edge'][div_ind_1] = True
+
+                                output_target[feature] = output_target[feature][remove_ind]
+
+                        elif div_ind_1.sum() == 1 or div_ind_2.sum() == 1:
+
+                            if div_ind_1.sum() == 1:
+                                div_ind = div_ind_1
+                                div_ind_orig = output_target['track_ids_orig'] == div_cur_track_ids[0]
+                            else:
+                                div_ind = div_ind_2
+                                div_ind_orig = output_target['track_ids_orig'] == div_cur_track_ids[1]
+                                div_cur_track_ids = torch.flip(div_cur_track_ids,dims=[0])
+
+                            assert div_ind_orig.sum() == 1
+                            output_target['track_ids'][div_ind] = prev_track_id
+                            output_target['track_ids_orig'][div_ind_orig] = prev_track_id
+
+                            assert target[training_method]['man_track'][target[training_method]['man_track'][:,0] == prev_track_id,2] == framenb-1
+
+                            # Have mother cell replace daughter cell that is still in frame 
+                            dau_cells = target[training_method]['man_track'][target[training_method]['man_track'][:,-1] == div_cur_track_ids[0],0]
+                            target[training_method]['man_track'][target[training_method]['man_track'][:,0] == dau_cells,-1] = prev_track_id
+                            target[training_method]['man_track'][target[training_method]['man_track'][:,0] == prev_track_id,2] = target[training_method]['man_track'][target[training_method]['man_track'][:,0] == div_cur_track_ids[0],2] 
+                            
+                            target[training_method]['man_track'][target[training_method]['man_track'][:,0] == div_cur_track_ids[0],1:] = -1 # remove cell from lineage since the mother cell replaced it
+                            target[training_method]['man_track'][target[training_method]['man_track'][:,0] == div_cur_track_ids[1],-1] = 0 # remove division track from other cell
+
+                            for future_target_name in future_target_names:
+                                fut_target = target[training_method][future_target_name]
+                                fut_target['track_ids'][fut_target['track_ids'] == div_cur_track_ids[0]] = prev_track_id
+                                fut_target['track_ids_orig'][fut_target['track_ids_orig'] == div_cur_track_ids[0]] = prev_track_id
+                            
+                    else:
+                        raise NotImplementedError
+
+            removed_cells_input = 0 
+            removed_cells_output = 0 
+
+            if 'new_cell_ids' in input_target:
+                removed_cells_input += len(input_target['new_cell_ids'])
+            if 'new_cell_ids' in output_target:
+                removed_cells_output += len(output_target['new_cell_ids'])
+
+            assert input_target['boxes_orig'].shape[0] == (input_target['boxes'].shape[0] + (input_target['boxes'][:,-1] > 0).sum().item() + removed_cells_input)
+            assert output_target['boxes_orig'].shape[0] == (output_target['boxes'].shape[0] + (output_target['boxes'][:,-1] > 0).sum().item() + removed_cells_output)
+
+    for target_name in target_names:
+        if len(target[training_method][target_name]['track_ids'].shape) == 1:
+            for track_id in target[training_method][target_name]['track_ids']:
+                if track_id not in target[training_method]['man_track'][:,0]:
+                    raise NotImplementedError
+
+    return targets
+
+
+def update_cropped_man_track(target):
+
+    target_names = ['prev_target','cur_target']
+
+    if 'prev_prev_target' in target:
+        target_names = ['prev_prev_target'] + target_names
+
+    if 'fut_target' in target:
+        target_names += ['fut_target']
+
+    man_track = target['man_track']
+    max_cellnb = target['man_track'][-1,0].item()
+
+    for target_name in target_names:
+
+        output_target_index = target_names.index(target_name)
+        future_target_names = [output_target_name for output_target_name in target_names if target_names.index(output_target_name) > output_target_index]
+
+        framenb = target[target_name]['framenb']
+
+        track_ids = man_track[(man_track[:,1] <= framenb) * (man_track[:,2] >= framenb),0]
+
+        for track_id in track_ids:
+
+            cell_track = man_track[man_track[:,0] == track_id][0]
+            # if cell is not in cropped frame and it wasn't just born
+            if track_id not in target[target_name]['track_ids'] and man_track[man_track[:,0] == track_id,1] != -1:
+
+                # If one of cells that divided are not present in frame, assume no division occured
+                if cell_track[-1] > 0 and cell_track[1] == framenb:
+                    other_dau_id = man_track[(man_track[:,-1] == cell_track[-1]) * (man_track[:,0] != track_id),0].item()
+
+                    man_track[man_track[:,0] == other_dau_id,-1] = 0
+                    man_track[man_track[:,0] == track_id,-1] = 0
+
+                    if other_dau_id in target[target_name]['track_ids']:
+
+                        mother_id = cell_track[-1]
+
+                        div_ind = target[target_name]['track_ids'] == other_dau_id
+                        div_ind_orig = target[target_name]['track_ids_orig'] == other_dau_id
+                        assert div_ind.sum() == 1 and div_ind_orig.sum() == 1
+                        target[target_name]['track_ids'][div_ind] = mother_id   
+                        target[target_name]['track_ids_orig'][div_ind_orig] = mother_id
+
+                        # Have mother cell replace daughter cell that is still in frame 
+                        dau_cells = man_track[man_track[:,-1] == other_dau_id,0]
+                        if len(dau_cells) > 0:
+                            man_track[man_track[:,0] == dau_cells[0],-1] = mother_id
+                            man_track[man_track[:,0] == dau_cells[1],-1] = mother_id
+                            
+                        man_track[man_track[:,0] == mother_id,2] = man_track[man_track[:,0] == other_dau_id,2] 
+                        
+                        man_track[man_track[:,0] == other_dau_id,1:] = -1 # remove cell from lineage since the mother cell replaced it
+                        man_track[man_track[:,0] == track_id,1] = framenb+1 # remove cell from lineage since the mother cell replaced it
+
+                        for future_target_name in future_target_names:
+                            fut_target = target[future_target_name]
+                            fut_target['track_ids'][fut_target['track_ids'] == other_dau_id] = mother_id
+                            fut_target['track_ids_orig'][fut_target['track_ids_orig'] == other_dau_id] = mother_id
+                        
+                    else:
+                        man_track[man_track[:,0] == other_dau_id,1] = framenb + 1
+                        man_track[man_track[:,0] == track_id,1] = framenb + 1
+
+                        if man_track[man_track[:,0] == other_dau_id,2] < man_track[man_track[:,0] == other_dau_id,1]:
+                            man_track[man_track[:,0] == other_dau_id,1:] = -1
+                            man_track[man_track[:,-1] == other_dau_id,-1] = 0
+
+                else:
+                    new_cell = True
+                
+                    for future_target_name in future_target_names:
+                        fut_target = target[future_target_name]
+                        fut_framenb = target[future_target_name]['framenb'].item()
+
+                        if track_id in fut_target['track_ids']:
+
+                            if new_cell:
+                                max_cellnb += 1
+
+                                exit_framenb = man_track[man_track[:,0] == track_id,2][0]
+                                new_cell = torch.tensor([[max_cellnb,fut_framenb,exit_framenb,0]]).to(man_track.device)
+                                man_track = torch.cat((man_track,new_cell))
+                                man_track[man_track[:,0] == track_id,2] = framenb-1
+
+                                dau_cells = man_track[man_track[:,-1] == track_id,0]
+
+                                if len(dau_cells) > 0:
+                                    man_track[man_track[:,0] == dau_cells[0],-1] = max_cellnb
+                                    man_track[man_track[:,0] == dau_cells[1],-1] = max_cellnb
+                                new_cell = False
+
+                            assert track_id in fut_target['track_ids'] and track_id in fut_target['track_ids_orig']
+
+                            fut_target['track_ids'][fut_target['track_ids'] == track_id] = max_cellnb
+                            fut_target['track_ids_orig'][fut_target['track_ids_orig'] == track_id] = max_cellnb
+                        else:
+                            new_cell = True
+
+                    man_track[man_track[:,0] == track_id,2] = framenb - 1 
+
+                    if track_id in man_track[:,-1]:
+                        dau_cells = man_track[man_track[:,-1] == track_id,0]
+                        if len(dau_cells) > 0:
+                            man_track[man_track[:,0] == dau_cells[0],-1] = 0                                           
+                            man_track[man_track[:,0] == dau_cells[1],-1] = 0                                           
+                
+                if man_track[man_track[:,0] == track_id,2] < man_track[man_track[:,0] == track_id,1]:
+                    man_track[man_track[:,0] == track_id,1:] = -1
+                    man_track[man_track[:,-1] == track_id,-1] = 0
+
+                    dau_cells = man_track[man_track[:,-1] == track_id,0]
+                    if len(dau_cells) > 0:
+                        man_track[man_track[:,0] == dau_cells[0],-1] = 0
+                        man_track[man_track[:,0] == dau_cells[1],-1] = 0
+                    
+    target['man_track'] = man_track
+
+    return target
@@ -0,0 +1,43 @@
+import torch
+
+from trackformer.util import box_ops
+
+from baseline_reference import masks_to_boxes as baseline_masks_to_boxes
+
+
+def random_masks(n, h, w, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    masks = torch.rand((n, h, w), generator=generator) > 0.9
+    masks[0] = False  # empty mask
+    masks[1] = False
+    masks[1, 3, 5] = True  # single pixel
+    masks[2] = False
+    masks[2, :, -1] = True  # touches the last column
+    return masks
+
+
+def test_masks_to_boxes_matches_baseline():
+    masks = random_masks(8, 12, 17)
+    for cxcywh in (False, True):
+        for batch in (masks, masks.float()):
+            expected = baseline_masks_to_boxes(batch, cxcywh=cxcywh)
+            assert torch.allclose(box_ops.masks_to_boxes(batch, cxcywh=cxcywh), expected)
+
+
+def test_masks_to_boxes_empty():
+    masks = torch.zeros((3, 5, 6), dtype=torch.bool)
+    assert torch.equal(box_ops.masks_to_boxes(masks), torch.zeros((3, 4)))
+    assert box_ops.masks_to_boxes(torch.zeros((0, 5, 6))).shape == (0, 4)
+
+
+def test_paired_box_iou_matches_generalized_box_iou():
+    generator = torch.Generator().manual_seed(0)
+    xy = torch.rand((10, 2, 2), generator=generator)
+    wh = torch.rand((10, 2, 2), generator=generator) * 0.5
+    boxes1 = torch.cat((xy[:, 0], xy[:, 0] + wh[:, 0]), dim=1)
+    boxes2 = torch.cat((xy[:, 1], xy[:, 1] + wh[:, 1]), dim=1)
+    boxes2[0] = boxes1[0]  # identical boxes
+    boxes2[1] = boxes1[1] + 2  # disjoint boxes
+
+    expected = box_ops.generalized_box_iou(boxes1, boxes2, return_iou_only=True).diagonal()
+    assert torch.allclose(box_ops.paired_box_iou(boxes1, boxes2), expected)
@@ -0,0 +1,134 @@
+import copy
+
+import pytest
+import torch
+
+from trackformer.util import misc
+
+import baseline_reference
+
+
+def assert_same(actual, expected, path='target'):
+    if isinstance(expected, dict):
+        assert actual.keys() == expected.keys(), path
+        for key in expected:
+            assert_same(actual[key], expected[key], f'{path}[{key!r}]')
+    elif isinstance(expected, (list, tuple)):
+        assert len(actual) == len(expected), path
+        for i, (a, e) in enumerate(zip(actual, expected)):
+            assert_same(a, e, f'{path}[{i}]')
+    elif isinstance(expected, torch.Tensor):
+        assert torch.equal(actual, expected), f'{path}: {actual} != {expected}'
+    else:
+        assert actual == expected, path
+
+
+@pytest.mark.parametrize('remaps', [
+    [(1, 2), (2, 3)],
+    [(2, 3), (1, 2)],
+    [(1, 2), (1, 3)],
+    [(4, 7), (7, 1), (5, 6)],
+])
+def test_remap_track_ids_matches_sequential_writes(remaps):
+    track_ids = torch.tensor([1, 2, 3, 4, 5, 7, 9])
+
+    expected = track_ids.clone()
+    for old_id, new_id in remaps:
+        expected[expected == old_id] = new_id
+
+    misc.remap_track_ids(track_ids, remaps)
+    assert torch.equal(track_ids, expected)
+
+
+def test_remap_track_ids_without_remaps():
+    track_ids = torch.tensor([1, 2, 3])
+    misc.remap_track_ids(track_ids, [])
+    assert torch.equal(track_ids, torch.tensor([1, 2, 3]))
+
+
+def frame(track_ids, framenb):
+    n = len(track_ids)
+    boxes = torch.zeros((n, 8))
+    boxes[:, :4] = torch.arange(1, n * 4 + 1, dtype=torch.float32).view(n, 4) / 100
+    is_touching_edge = torch.zeros(n, dtype=torch.bool)
+    is_touching_edge[-1] = True
+
+    return {
+        'empty': torch.tensor(False),
+        'framenb': torch.tensor(framenb),
+        'track_ids': torch.tensor(track_ids),
+        'track_ids_orig': torch.tensor(track_ids),
+        'boxes_orig': boxes,
+        'labels_orig': torch.zeros((n, 2), dtype=torch.int64),
+        'flexible_divisions_orig': torch.zeros(n, dtype=torch.bool),
+        'is_touching_edge_orig': is_touching_edge,
+    }
+
+
+def division_targets():
+    # Cell 1 divides into 2 and 3 in frame 1; cell 4 is tracked throughout
+    man_track = torch.tensor([[1, 0, 0, 0], [2, 1, 2, 1], [3, 1, 2, 1], [4, 0, 2, 0]])
+    return [{'main': {
+        'prev_target': frame([1, 4], 0),
+        'cur_target': frame([2, 3, 4], 1),
+        'fut_target': frame([2, 3, 4], 2),
+        'man_track': man_track,
+    }}]
+
+
+def run_man_track_ids(targets, *args):
+    expected = baseline_reference.man_track_ids(copy.deepcopy(targets), *args)
+    actual = misc.man_track_ids(copy.deepcopy(targets), *args)
+    assert_same(actual, expected)
+    return actual
+
+
+def test_man_track_ids_merges_divided_cells():
+    targets = run_man_track_ids(division_targets(), 'main', 'prev_target', 'cur_target')
+    assert torch.equal(targets[0]['main']['cur_target']['track_ids'], torch.tensor([1, 4]))
+
+
+def test_man_track_ids_skips_unmatched_cells():
+    targets = division_targets()
+    targets[0]['main']['cur_target']['target_ind_matching'] = torch.tensor([False, True])
+    targets[0]['main']['cur_target']['num_FPs'] = 0
+
+    targets = run_man_track_ids(targets, 'main', 'prev_target', 'cur_target')
+    assert torch.equal(targets[0]['main']['cur_target']['track_ids'], torch.tensor([2, 3, 4]))
+
+
+def test_man_track_ids_with_prev_ind():
+    targets = division_targets()
+    targets[0]['main']['cur_target']['prev_ind'] = [torch.tensor([0, 1]), torch.tensor([1, 0])]
+
+    run_man_track_ids(targets, 'main', 'prev_target', 'cur_target')
+
+
+def test_man_track_ids_tracked_cells_only():
+    targets = division_targets()
+    run_man_track_ids(targets, 'main', 'cur_target', 'fut_target')
+
+
+def cropped_target(man_track, prev_ids, cur_ids, fut_ids):
+    return {
+        'man_track': torch.tensor(man_track),
+        'prev_target': {'framenb': torch.tensor(0), 'track_ids': torch.tensor(prev_ids), 'track_ids_orig': torch.tensor(prev_ids)},
+        'cur_target': {'framenb': torch.tensor(1), 'track_ids': torch.tensor(cur_ids), 'track_ids_orig': torch.tensor(cur_ids)},
+        'fut_target': {'framenb': torch.tensor(2), 'track_ids': torch.tensor(fut_ids), 'track_ids_orig': torch.tensor(fut_ids)},
+    }
+
+
+@pytest.mark.parametrize('target', [
+    # Cell 2 leaves the crop in frame 1 and comes back in frame 2 as a new cell
+    cropped_target([[1, 0, 2, 0], [2, 0, 2, 0]], [1, 2], [1], [1, 2]),
+    # Daughter 3 is cropped out, so the mother replaces daughter 2
+    cropped_target([[1, 0, 0, 0], [2, 1, 2, 1], [3, 1, 2, 1]], [1], [2], [2, 3]),
+    # Both daughters are cropped out of frame 1 and come back in frame 2
+    cropped_target([[1, 0, 0, 0], [2, 1, 2, 1], [3, 1, 2, 1], [4, 0, 2, 0]], [1, 4], [4], [2, 3, 4]),
+    # The mother is cropped out of frame 0 so its daughters get a new parent id
+    cropped_target([[1, 0, 1, 0], [2, 2, 2, 1], [3, 2, 2, 1], [4, 0, 2, 0]], [4], [1, 4], [2, 3, 4]),
+])
+def test_update_cropped_man_track_matches_baseline(target):
+    expected = baseline_reference.update_cropped_man_track(copy.deepcopy(target))
+    actual = misc.update_cropped_man_track(copy.deepcopy(target))
+    assert_same(actual, expected)